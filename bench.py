@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+
+# Benchmarks dedup.py, phase by phase, against synthetic trees.
+#
+# A tree is generated from a seed and a handful of shape parameters, so the
+# same command line always measures the same tree.  Each run prints one JSON
+# object on stdout (commentary goes to stderr), suitable for appending to a
+# file and comparing across commits.
+
+import json, os, random, shutil, subprocess, sys, tempfile, time
+import dedup
+
+# default tree shape:
+DEFAULTS = {
+    'seed': 1,
+    'files': 10000,
+    'depth': 4,
+    'fanout': 4,
+    'min_size': 0,
+    'max_size': 1048576,
+    'dup_ratio': 0.3,
+    'dup_dir_ratio': 0.05,
+}
+
+# the generated tree is split between this many top level arguments:
+TOP_DIRS = ('a', 'b', 'c')
+
+# a tree is only regenerated when its parameters change:
+STAMP = '.bench-params'
+
+def log(message):
+    sys.stderr.write('# ' + message + '\n')
+
+def file_size(rng, params):
+    """Sizes are log-uniform between min_size and max_size, so there are
+    many small files and a few large ones, like most real trees
+    """
+    low=max(1, params['min_size'])
+    high=max(low, params['max_size'])
+    size=int(round(low * (float(high) / low) ** rng.random()))
+    if params['min_size'] == 0 and rng.random() < 0.02:
+        size=0                  # a sprinkling of empty files
+    return size
+
+def file_contents(index, size):
+    """Distinct file indexes give distinct contents of a given size.  The
+    index is repeated throughout, so files of equal size differ in every
+    sampled block and not just the first.
+    """
+    block=('%012d\n' % index) * 342          # 4104 bytes
+    return (block * (size / len(block) + 1))[:size]
+
+def make_dirs(rng, params):
+    """Returns the relative paths of a random skeleton of directories,
+    at most depth deep and with at most fanout subdirectories each
+    """
+    dirs=list(TOP_DIRS)
+    pending=list(TOP_DIRS)
+    while len(pending):
+        d=pending.pop(0)
+        if d.count('/') + 1 >= params['depth']:
+            continue
+        for i in xrange(rng.randint(1, params['fanout'])):
+            sd=d + '/d' + str(i)
+            dirs.append(sd)
+            pending.append(sd)
+    return dirs
+
+def make_tree(root, params):
+    """Generates the tree described by params under root, unless it is
+    already there
+    """
+    stampPathname=os.path.join(root, STAMP)
+    stamp=json.dumps(params, sort_keys=True)
+    try:
+        with open(stampPathname) as f:
+            if f.read() == stamp:
+                log('reusing tree in ' + root)
+                return
+    except IOError:
+        pass
+
+    log('generating tree in ' + root)
+    for name in TOP_DIRS:
+        shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+
+    rng=random.Random(params['seed'])
+    dirs=make_dirs(rng, params)
+    for d in dirs:
+        os.makedirs(os.path.join(root, d))
+
+    # duplicate files reuse the contents of a file written earlier
+    written=[]
+    for i in xrange(params['files']):
+        if len(written) and rng.random() < params['dup_ratio']:
+            index, size=rng.choice(written)
+        else:
+            index, size=i, file_size(rng, params)
+            written.append((index, size))
+        pathname=os.path.join(root, rng.choice(dirs), 'f' + str(i))
+        with open(pathname, 'wb') as f:
+            f.write(file_contents(index, size))
+
+    # duplicate directories are whole copies of a subdirectory placed
+    # elsewhere, never inside themselves
+    subdirs=[ d for d in dirs if '/' in d ]
+    for i in xrange(int(len(subdirs) * params['dup_dir_ratio'])):
+        source=rng.choice(subdirs)
+        parents=[ d for d in dirs if d != source and not d.startswith(source + '/') ]
+        target=os.path.join(rng.choice(parents), 'copy' + str(i))
+        shutil.copytree(os.path.join(root, source), os.path.join(root, target))
+
+    with open(stampPathname, 'w') as f:
+        f.write(stamp)
+
+def drop_caches():
+    """Asks the kernel to forget cached file data, which takes root.
+    Returns whether it worked.
+    """
+    try:
+        subprocess.call([ 'sync' ])
+        with open('/proc/sys/vm/drop_caches', 'w') as f:
+            f.write('3\n')
+        return True
+    except (IOError, OSError):
+        return False
+
+def commit_id():
+    """The git commit of dedup.py being measured, if we can tell"""
+    here=os.path.dirname(os.path.abspath(dedup.__file__))
+    try:
+        with open(os.devnull, 'w') as null:
+            return subprocess.check_output([ 'git', 'rev-parse', '--short', 'HEAD' ],
+                                           cwd=here, stderr=null).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_once(databasePathname):
+    """Runs every phase of dedup on the TOP_DIRS of the current directory,
+    returning the seconds spent in each and some counts.  Passes run
+    through dedup.resolve_all, timed by dedup's own stats.
+    """
+    timings={}
+    dedup.stats=dedup.Stats()           # phase timings add up across runs
+    realStdout=sys.stdout
+    realStderr=sys.stderr
+    sys.stdout=open(os.devnull, 'w')    # dedup is chatty
+    sys.stderr=sys.stdout
+    try:
+        start=time.time()
+        allFiles=dedup.EntryList(list(TOP_DIRS), databasePathname, False)
+        timings['scan_and_hash']=time.time() - start
+
+        passCount=dedup.resolve_all(allFiles)
+        for key, phase in (('prune_empty', 'pruning'), ('build_hashmap', 'building the hash map'),
+                           ('resolve', 'resolving')):
+            timings[key]=dedup.stats.timings.get(phase, 0.0)
+
+        start=time.time()
+        allFiles.generate_commands()
+        timings['generate_commands']=time.time() - start
+    finally:
+        sys.stdout.close()
+        sys.stdout=realStdout
+        sys.stderr=realStderr
+
+    return {
+        'timings': timings,
+        'passes': passCount,
+        'entries': len(allFiles.fileList) + allFiles.dirCount,
+        'deleted': allFiles.count_deleted(),
+        'deleted_bytes': allFiles.count_deleted_bytes(),
+        'unique_size_bytes': allFiles.uniqueSizeBytes,
+        'sampled_bytes': allFiles.sampledBytes,
+    }
+
+def benchmark(root, params, variants, repeat, databaseFormat):
+    """Measures each variant repeat times, printing a JSON object per run.
+
+    cold:    no hash cache.  page cache dropped first, when we are root.
+    warm-db: a hash cache populated by an unmeasured run beforehand.
+    """
+    make_tree(root, params)
+    commit=commit_id()
+    os.chdir(root)
+    for variant in variants:
+        dbDir=None
+        databasePathname=None
+        if variant == 'warm-db':
+            dbDir=tempfile.mkdtemp(prefix='dedup-bench-')
+            databasePathname=os.path.join(dbDir, 'cache')
+            if databaseFormat == 'sqlite':
+                databasePathname='sqlite:' + databasePathname
+            log('populating ' + databasePathname)
+            run_once(databasePathname)
+        for i in xrange(repeat):
+            droppedCaches=False
+            if variant == 'cold':
+                droppedCaches=drop_caches()
+            result=run_once(databasePathname)
+            result.update({
+                'variant': variant,
+                'run': i,
+                'dropped_caches': droppedCaches,
+                'commit': commit,
+                'params': params,
+                'jobs': dedup.jobs,
+                'hash': dedup.hashName,
+            })
+            print json.dumps(result, sort_keys=True)
+            sys.stdout.flush()
+            log(variant + ' run ' + str(i) + ': ' + ', '.join(
+                '%s %.3fs' % (k, v) for k, v in sorted(result['timings'].items())))
+        if dbDir != None:
+            shutil.rmtree(dbDir)
+
+def usage():
+    print >>sys.stderr, 'usage: bench.py [ options ] tree_directory'
+    print >>sys.stderr, ''
+    print >>sys.stderr, '  --seed n, --files n, --depth n, --fanout n,'
+    print >>sys.stderr, '  --min-size bytes, --max-size bytes,'
+    print >>sys.stderr, '  --dup-ratio fraction, --dup-dir-ratio fraction    tree shape'
+    print >>sys.stderr, '  --variant cold|warm-db    (repeatable, default both)'
+    print >>sys.stderr, '  --db-format gdbm|sqlite   cache used by warm-db (default gdbm)'
+    print >>sys.stderr, '  -r/--repeat n             runs per variant (default 3)'
+    print >>sys.stderr, '  -j/--jobs n, --hash name  passed on to dedup'
+    sys.exit(-1)
+
+if __name__ == '__main__':
+    sys.argv.pop(0)             # do away with the command itself
+
+    params=dict(DEFAULTS)
+    variants=[]
+    repeat=3
+    databaseFormat='gdbm'
+    try:
+        while len(sys.argv) > 1:
+            nextArg=sys.argv.pop(0)
+            if nextArg in ('--seed', '--files', '--depth', '--fanout', '--min-size', '--max-size'):
+                params[nextArg[2:].replace('-', '_')]=int(sys.argv.pop(0))
+            elif nextArg in ('--dup-ratio', '--dup-dir-ratio'):
+                params[nextArg[2:].replace('-', '_')]=float(sys.argv.pop(0))
+            elif nextArg == '--variant':
+                variant=sys.argv.pop(0)
+                if variant not in ('cold', 'warm-db'):
+                    usage()
+                variants.append(variant)
+            elif nextArg == '--db-format':
+                databaseFormat=sys.argv.pop(0)
+                if databaseFormat not in ('gdbm', 'sqlite'):
+                    usage()
+            elif nextArg == '-r' or nextArg == '--repeat':
+                repeat=int(sys.argv.pop(0))
+            elif nextArg == '-j' or nextArg == '--jobs':
+                dedup.jobs=int(sys.argv.pop(0))
+            elif nextArg == '--hash':
+                dedup.hashName=sys.argv.pop(0)
+            else:
+                usage()
+    except (IndexError, ValueError):
+        usage()
+    if len(sys.argv) != 1:
+        usage()
+    if len(variants) == 0:
+        variants=[ 'cold', 'warm-db' ]
+
+    root=os.path.abspath(sys.argv[0])
+    if not os.path.isdir(root):
+        os.makedirs(root)
+    benchmark(root, params, variants, repeat, databaseFormat)
+
+# vim: set expandtab sw=4 ts=4:
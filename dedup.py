@@ -1,8 +1,25 @@
 #!/usr/bin/env python
 
-import hashlib, os, sys, stat, time, gdbm
+import binascii, collections, cProfile, ctypes, ctypes.util, errno, fcntl, fnmatch, hashlib, heapq, io, itertools, json, marshal, os, Queue, re, resource, select, shutil, socket, struct, sys, stat, tempfile, threading, time, gdbm, sqlite3
+from multiprocessing.pool import ThreadPool
 
-# TODO exclude and include filters
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None          # fall back to os.listdir and os.lstat
+
+try:
+    import xxhash               # fast, non-cryptographic digests
+except ImportError:
+    xxhash = None
+
+try:
+    import pyblake2             # blake2 for pythons whose hashlib lacks it
+except ImportError:
+    pyblake2 = None
 
 # CONSTANTS:
 
@@ -19,9 +36,162 @@ doNotDeletList = []
 # size of hashing buffer:
 BUF_SIZE = 65536  
 
+# same-sized files are first compared by a fingerprint of their first
+# block, their last block and SAMPLE_COUNT blocks evenly spaced between:
+SAMPLE_SIZE = 4096
+SAMPLE_COUNT = 3
+
+# with --external-sort, HashMap records are sorted and written to disk
+# in runs of this many:
+SPILL_RECORDS = 1000000
+
+# files larger than this are hashed a chunk at a time, and their digest is
+# the digest of their chunk digests.  a file which was appended to is then
+# only read from its last chunk on, once a sample of every chunk before it
+# still matches, see FileObj.read_digest().
+HASH_CHUNK = 64 * 1024 * 1024
+
+# --verify keeps at most this many files of a group open at once.  larger
+# groups are read by reopening each file for every chunk.
+VERIFY_OPEN = 256
+
+# ioctl asking Linux where a file's extents are on disk, and the sizes
+# of struct fiemap and of the one struct fiemap_extent we ask for:
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP_SIZE = 32
+FIEMAP_EXTENT_SIZE = 56
+
+# manifests start with this tag and format version, see
+# EntryList.write_manifest():
+MANIFEST_TAG = 'dedup-manifest'
+MANIFEST_VERSION = 3
+
+# inotify event flags, from <sys/inotify.h>:
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR | IN_DONT_FOLLOW
+
+# a --watch process waits for events to stop arriving for this long, in
+# seconds, before acting on them
+WATCH_SETTLE = 0.2
+
+# --clean-database checks the keys of the db in sorted batches of this
+# many, deleting the dead keys of one batch while the next is checked:
+GC_BATCH = 10000
+
+# keys are checked by at least this many threads, as stat'ing is all they
+# do (-j can raise it):
+GC_JOBS = 8
+
+# and the db is only reorganized once this fraction of its keys is gone:
+GC_REORGANIZE = 0.1
+
+# prefix of the db keys of directory digests, see directory_key():
+DIRECTORY_KEY = '\0dir:'
+
+# live progress is redrawn at most this often, in seconds:
+PROGRESS_INTERVAL = 1.0
+
+# cache entries are committed to sqlite this many at a time:
+CACHE_BATCH = 1000
+
+# shared by every DirObj without files (or without subdirs), until the
+# scanner gives it a dict of its own.  never add to it.
+NO_CHILDREN = {}
+
 # default to quiet mode:
 verbose=False
 
+# number of files to hash at once:
+jobs=1
+
+# number of files to hash at once from any one spinning disk:
+hddJobs=1
+
+# digest algorithm for files and directories:
+hashName='sha1'
+
+# hash every file in full, even those no other file here could match.
+# set for manifests, whose files may match files scanned elsewhere.
+hashAll=False
+
+# compare duplicate files byte by byte before trusting their digests:
+verifyContents=False
+
+# --exclude and --include patterns, see compile_pattern(), and the
+# --min-size and --max-size limits.  files given as arguments are never
+# filtered.
+excludeList=[]
+includeList=[]
+minSize=None
+maxSize=None
+
+# format of the deletion plan, see emit_group():
+outputFormat='shell'
+OUTPUT_FORMATS = ('shell', 'jsonl', 'nul')
+
+# the plan is written here.  with the jsonl and nul formats, everything
+# else we print goes to stderr so the plan can be piped on its own.
+planStream=sys.stdout
+
+# each hashing thread reads into its own reusable buffer:
+threadLocal=threading.local()
+
+def hash_algorithms():
+    """Returns the names accepted by --hash"""
+    names=set(getattr(hashlib, 'algorithms_available', hashlib.algorithms))
+    if pyblake2 != None:
+        names.update([ 'blake2b', 'blake2s' ])
+    if xxhash != None:
+        names.update([ n for n in ('xxh32', 'xxh64', 'xxh3_64', 'xxh3_128') if hasattr(xxhash, n) ])
+    return sorted(names)
+
+def new_hash():
+    """Returns a fresh hash object of the selected algorithm"""
+    if hashName.startswith('xxh'):
+        return getattr(xxhash, hashName)()
+    if hashName.startswith('blake2') and pyblake2 != None:
+        return getattr(pyblake2, hashName)()
+    return hashlib.new(hashName)
+
+def hash_buffer():
+    """Returns this thread's BUF_SIZE read buffer, as a memoryview"""
+    if getattr(threadLocal, 'buffer', None) == None or len(threadLocal.buffer) != BUF_SIZE:
+        threadLocal.buffer=memoryview(bytearray(BUF_SIZE))
+    return threadLocal.buffer
+
+def hash_range(f, h, buf, length):
+    """Feeds the next length bytes of the unbuffered file f to the hash h,
+    reading through buf.  Stops early if the file is shorter.
+    """
+    while length > 0:
+        n = f.readinto(buf[:min(length, len(buf))])
+        if not n:
+            break
+        h.update(buf[:n])
+        length = length - n
+
+def sample_range(f, offset, length):
+    """Returns a fingerprint of the length bytes of f at offset: their
+    first block, their last block and SAMPLE_COUNT blocks between
+    """
+    h = new_hash()
+    step=(length - SAMPLE_SIZE) / (SAMPLE_COUNT + 1)
+    for i in xrange(SAMPLE_COUNT + 1):
+        f.seek(offset + i * step)
+        h.update(f.read(SAMPLE_SIZE))
+    f.seek(offset + length - SAMPLE_SIZE)
+    h.update(f.read(SAMPLE_SIZE))
+    return h.hexdigest()
+
 def resolve_candidates(candidates, currentDepth=None):
     """Helper function which examines a list of candidate objects with identical
     contents (as determined elsewhere) to determine which of the candidates is
@@ -72,24 +242,365 @@ def resolve_candidates(candidates, currentDepth=None):
 
     return winner, losers
         
-def issocket(path):
-    """For some reason python provides isfile and isdirectory but not issocket"""
-    mode = os.stat(path).st_mode
-    return stat.S_ISSOCK(mode)
+def parallel_map(function, items):
+    """Like itertools.imap, but spread across a pool of 'jobs' threads.
+    Results are yielded in order, as soon as they are available.  hashlib
+    and file reads release the GIL, so threads keep several disks and
+    cores busy without having to pickle the tree for a process pool.
+    """
+    if jobs < 2 or len(items) < 2:
+        for item in items:
+            yield function(item)
+        return
+
+    pool=ThreadPool(min(jobs, len(items)))
+    try:
+        for result in pool.imap(function, items):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+def read_chunk(fileEntry, handles, offset):
+    """Returns BUF_SIZE bytes of fileEntry at offset.  Files are kept open
+    in handles, unless handles is None.
+    """
+    if handles == None:
+        with open(fileEntry.pathname, 'rb') as f:
+            f.seek(offset)
+            return f.read(BUF_SIZE)
+    if fileEntry not in handles:
+        handles[fileEntry]=open(fileEntry.pathname, 'rb')
+    return handles[fileEntry].read(BUF_SIZE)
+
+def verify_group(members):
+    """Reads the files in members, which share a digest, in lock-step one
+    chunk at a time so each chunk of each file is read once.  Files are
+    split off as soon as they diverge, and files we fail to read drop out.
+    Returns (groups of files with identical contents, bytes read).
+    """
+    handles=None
+    if len(members) <= VERIFY_OPEN:
+        handles={}
+    pending=[ members ]         # groups identical so far
+    groups=[]
+    offset=0
+    bytesRead=0
+    try:
+        while len(pending):
+            stillPending=[]
+            for group in pending:
+                chunks={}
+                for fileEntry in group:
+                    try:
+                        data=read_chunk(fileEntry, handles, offset)
+                    except (IOError, OSError):
+                        print '# could not verify ' + fileEntry.pathname
+                        groups.append([ fileEntry ])
+                        continue
+                    bytesRead = bytesRead + len(data)
+                    if data in chunks:
+                        chunks[data].append(fileEntry)
+                    else:
+                        chunks[data] = [ fileEntry ]
+                for data, sameData in chunks.iteritems():
+                    if len(data) == 0 or len(sameData) == 1:
+                        groups.append(sameData)
+                    else:
+                        stillPending.append(sameData)
+            pending=stillPending
+            offset = offset + BUF_SIZE
+    finally:
+        if handles != None:
+            for f in handles.itervalues():
+                f.close()
+    return groups, bytesRead
+
+def is_rotational(device):
+    """Asks sysfs whether device is a spinning disk.  Partitions keep
+    the answer with their disk, one directory up.  False if we cannot tell.
+    """
+    base='/sys/dev/block/' + str(os.major(device)) + ':' + str(os.minor(device))
+    for pathname in (base + '/queue/rotational', base + '/../queue/rotational'):
+        try:
+            with open(pathname) as f:
+                return f.read().strip() == '1'
+        except IOError:
+            pass
+    return False
+
+def physical_offset(pathname):
+    """Returns where the first extent of pathname starts on its disk, or
+    None if it has none (it is empty or inline).  Raises IOError where
+    the filesystem does not support FIEMAP.
+    """
+    request=struct.pack('=QQLLLL', 0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0) + '\0' * FIEMAP_EXTENT_SIZE
+    with open(pathname, 'rb') as f:
+        reply=fcntl.ioctl(f.fileno(), FS_IOC_FIEMAP, request)
+    mappedExtents=struct.unpack_from('=L', reply, 20)[0]
+    if mappedExtents == 0:
+        return None
+    return struct.unpack_from('=Q', reply, FIEMAP_SIZE + 8)[0]
+
+def device_order(files):
+    """Groups files by device, each group sorted into the order its disk
+    reads them best: by the physical offset of their data on spinning
+    disks whose filesystem reports it, by inode number otherwise.
+    Returns a dict of device to (file list, whether it is rotational).
+    """
+    deviceMap={}
+    for fileEntry in files:
+        if fileEntry.device in deviceMap:
+            deviceMap[fileEntry.device].append(fileEntry)
+        else:
+            deviceMap[fileEntry.device] = [ fileEntry ]
+
+    for device, deviceFiles in deviceMap.iteritems():
+        rotational=is_rotational(device)
+        deviceMap[device]=(deviceFiles, rotational)
+        if not rotational:
+            deviceFiles.sort(key=lambda f: f.inode)
+            continue
+        offsets={}
+        try:
+            for fileEntry in deviceFiles:
+                try:
+                    offsets[fileEntry]=(physical_offset(fileEntry.pathname), fileEntry.inode)
+                except IOError, e:
+                    if e.errno in (errno.ENOTTY, errno.EOPNOTSUPP, errno.EINVAL):
+                        raise
+                    offsets[fileEntry]=(None, fileEntry.inode)
+            deviceFiles.sort(key=offsets.get)
+        except IOError:
+            # no FIEMAP on this filesystem
+            deviceFiles.sort(key=lambda f: f.inode)
+    return deviceMap
+
+def scheduled_map(function, files):
+    """Like parallel_map for FileObjs, but yields (file, result) pairs in
+    the order they finish.  Every device gets readers of its own, taking
+    its files in device_order(): hddJobs of them for a spinning disk and
+    jobs for anything else.  No more than jobs read at once overall, so
+    every disk is kept busy without any one of them seeking back and forth.
+    """
+    deviceMap=device_order(files)
+    if jobs < 2 or len(files) < 2:
+        for device in sorted(deviceMap.keys()):
+            for fileEntry in deviceMap[device][0]:
+                yield fileEntry, function(fileEntry)
+        return
+
+    results=Queue.Queue()
+    slots=threading.Semaphore(jobs)
+    def read(queue):
+        while True:
+            try:
+                fileEntry=queue.popleft()
+            except IndexError:
+                return
+            with slots:
+                try:
+                    results.put((fileEntry, function(fileEntry), None))
+                except Exception:
+                    results.put((fileEntry, None, sys.exc_info()))
+
+    for device, (deviceFiles, rotational) in deviceMap.iteritems():
+        queue=collections.deque(deviceFiles)
+        readers=jobs
+        if rotational:
+            readers=hddJobs
+        for i in xrange(min(readers, len(deviceFiles))):
+            thread=threading.Thread(target=read, args=(queue,))
+            thread.daemon=True
+            thread.start()
+
+    for i in xrange(len(files)):
+        # a timeout keeps the wait interruptible
+        fileEntry, value, error = results.get(True, 1e9)
+        if error != None:
+            raise error[0], error[1], error[2]
+        yield fileEntry, value
+
+def peak_memory():
+    """Returns the peak resident set size of this process, in bytes"""
+    peak=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak             # already in bytes
+    return peak * 1024
+
+def format_bytes(bytes):
+    """Returns a byte count in the largest unit that keeps it above one"""
+    for unit in ('B', 'KiB', 'MiB', 'GiB', 'TiB'):
+        if bytes < 1024 or unit == 'TiB':
+            break
+        bytes = bytes / 1024.0
+    if unit == 'B':
+        return str(int(bytes)) + ' B'
+    return '%.1f %s' % (bytes, unit)
+
+def format_seconds(seconds):
+    """Returns h:mm:ss, or fractional seconds under a minute"""
+    if seconds < 60:
+        return '%.2fs' % seconds
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '%d:%02d:%02d' % (hours, minutes, seconds)
+
+def read_records(pathname):
+    """A generator yielding the marshal records of a file, such as a run
+    written by HashMap.write_run or a manifest
+    """
+    with open(pathname, 'rb') as f:
+        while True:
+            try:
+                yield marshal.load(f)
+            except EOFError:
+                return
+
+def describe_mode(mode):
+    """Names the kinds of entries we refuse to read"""
+    if stat.S_ISSOCK(mode):
+        return 'socket'
+    if stat.S_ISFIFO(mode):
+        return 'fifo'
+    if stat.S_ISCHR(mode) or stat.S_ISBLK(mode):
+        return 'device node'
+    return 'special file'
+
+def scan_entries(path, skip=None):
+    """A generator yielding (name, isDir, statResult) for each entry in path.
+    Real subdirectories come back with isDir set and no statResult (scandir
+    knows them from the directory listing alone).  Everything else is stat'ed
+    exactly once, following symlinks to files but never into directories, as
+    os.walk does.  statResult is None for dangling symlinks.  Names for which
+    skip returns True are left out before anything is stat'ed.
+    """
+    if scandir != None:
+        for e in scandir(path):
+            if skip != None and skip(e.name):
+                continue
+            if e.is_dir(follow_symlinks=False):
+                yield e.name, True, None
+                continue
+            try:
+                if e.is_symlink():
+                    statResult=os.stat(e.path)
+                else:
+                    statResult=e.stat(follow_symlinks=False)
+            except OSError:
+                statResult=None
+            yield e.name, False, statResult
+        return
+
+    for name in os.listdir(path):
+        if skip != None and skip(name):
+            continue
+        pathname=path + '/' + name
+        try:
+            statResult=os.lstat(pathname)
+            if stat.S_ISLNK(statResult.st_mode):
+                statResult=os.stat(pathname)
+            elif stat.S_ISDIR(statResult.st_mode):
+                yield name, True, None
+                continue
+        except OSError:
+            statResult=None
+        yield name, False, statResult
+
+def shell_quote(filename):
+    """Wraps filename in single quotes, which the shell takes literally,
+    closing and reopening them around any single quotes it contains
+    """
+    return "'" + filename.replace("'", "'\\''") + "'"
 
 def generate_delete(filename):
-    # characters that we will wrap with double quotes:
-    delimTestChars = set("'()")
-    if any((c in delimTestChars) for c in filename):
-        print 'rm -rf "' + filename + '"'
+    print 'rm -rf ' + shell_quote(filename)
+
+def json_path(pathname):
+    """JSON strings are unicode, so names which are not UTF-8 are passed
+    through as latin-1 (use the nul format where every byte matters)
+    """
+    try:
+        return pathname.decode('utf-8')
+    except UnicodeDecodeError:
+        return pathname.decode('latin-1')
+
+def group_bytes(allFiles, losers, reason):
+    """Bytes freed by deleting losers (not including directory files).
+    A hardlinked file only frees its space along with the last of its
+    links, see EntryList.freed_bytes.  Other files of an emptied directory
+    were counted as they were deleted, except ignored ones.
+    """
+    bytes=0
+    for loser in losers:
+        for e in loser.walk():
+            if not isinstance(e, FileObj):
+                continue
+            if reason == 'empty directory' and not e.ignore and not allFiles.shares_inode(e):
+                continue
+            bytes = bytes + allFiles.freed_bytes(e)
+    return bytes
+
+def emit_group(allFiles, winner, losers, reason):
+    """Streams one resolved group to planStream as soon as it is decided.
+    A winner of None means the losers are (or were left) empty.  Unlike
+    the shell format, later records may cover the paths of earlier ones
+    (e.g. a directory emptied by removing its duplicate files).
+    """
+    if outputFormat == 'jsonl':
+        record={ 'winner': None, 'losers': [ json_path(l.pathname) for l in losers ],
+                 'bytes': group_bytes(allFiles, losers, reason), 'reason': reason }
+        if winner != None:
+            record['winner']=json_path(winner.pathname)
+        planStream.write(json.dumps(record, sort_keys=True) + '\n')
+    elif outputFormat == 'nul':
+        for loser in losers:
+            planStream.write(loser.pathname + '\0')
     else:
-        print "rm -rf '" + filename + "'"
+        return                  # the shell format is written by generate_commands
+    planStream.flush()
 
 def check_int(s):
     if s[0] in ('-', '+'):
         return s[1:].isdigit()
     return s.isdigit()
 
+def compile_pattern(pattern):
+    """Turns an --exclude or --include pattern into a (regex, wholePath,
+    isGlob) tuple.  Patterns starting with re: are regular expressions
+    searched for in the path beneath the scanned argument.  Other patterns
+    are globs, matched against that whole path if they contain a slash and
+    against the last name in it otherwise.
+    """
+    if pattern.startswith('re:'):
+        return re.compile(pattern[3:]), True, False
+    return re.compile(fnmatch.translate(pattern)), '/' in pattern, True
+
+def matches(patterns, relativePath):
+    """Whether any compiled pattern matches relativePath"""
+    name=relativePath.rpartition('/')[2]
+    for regex, wholePath, isGlob in patterns:
+        subject=relativePath if wholePath else name
+        # fnmatch.translate anchors the end only, so globs must match
+        # from the start as well
+        if (regex.match(subject) if isGlob else regex.search(subject)):
+            return True
+    return False
+
+def excluded(relativePath):
+    """Whether --exclude leaves out the entry at relativePath.  Nothing is
+    known of the entry but its path, so nothing need be stat'ed first.
+    """
+    return len(excludeList) > 0 and matches(excludeList, relativePath)
+
+def filtered_file(relativePath, statResult):
+    """Whether --include or the size limits leave out the file at relativePath"""
+    if minSize != None and statResult.st_size < minSize:
+        return True
+    if maxSize != None and statResult.st_size > maxSize:
+        return True
+    return len(includeList) > 0 and not matches(includeList, relativePath)
+
 def check_level(pathname):
     parts=pathname.split(':')
     if len(parts) > 1:
@@ -101,68 +612,974 @@ def check_level(pathname):
     # if anything goes wrong just fail back to assuming the whole thing is a path
     return 0, pathname
 
+def nested_arguments(arguments):
+    """Returns a dict of the arguments which name, once symlinks are
+    followed, an earlier argument or something beneath another argument,
+    to that argument.  Scanning them as well would make every file in them
+    a copy of itself.
+    """
+    realPaths=[ os.path.realpath(check_level(argument.rstrip('/'))[1]) for argument in arguments ]
+    nested={}
+    for i in xrange(len(arguments)):
+        for j in xrange(len(arguments)):
+            if i != j and ((j < i and realPaths[i] == realPaths[j]) or
+                           realPaths[i].startswith(realPaths[j].rstrip('/') + '/')):
+                nested[arguments[i]]=arguments[j]
+                break
+    return nested
+
+def decode_cache_value(value):
+    """Turns a stored value into a dict of cached values.  Older databases
+    stored nothing but the full digest, so a bare value is read as such.
+    """
+    if '=' not in value:
+        return { 'sha1': value }
+    entry={}
+    for field in value.split('\0'):
+        k, v = field.split('=', 1)
+        entry[k]=v
+    return entry
+
+def encode_cache_value(entry):
+    """Turns a dict of cached values into a stored value.  Fields are NUL
+    separated as values (pathnames in particular) may hold anything else.
+    """
+    fields=[]
+    for k in sorted(entry.keys()):
+        fields.append(k + '=' + entry[k])
+    return '\0'.join(fields)
+
+def cache_field(field, bytes=0):
+    """Names the db field holding a 'sample', 'digest', 'chunks' or 'token' value.
+    Fields are named after the algorithm which produced them so that
+    switching --hash never mixes incompatible values.  Digests of files
+    over HASH_CHUNK are kept apart from whole-file digests for the same
+    reason.
+    """
+    if field == 'digest':
+        if bytes > HASH_CHUNK:
+            return 'chunked-' + hashName
+        return hashName
+    return field + '-' + hashName
+
+def identity_key(device, inode):
+    """Names the secondary db entry for a file, found by (device, inode) so
+    that renamed and moved files still hit the cache.  No pathname can
+    contain a NUL, so these never collide with pathname keys.
+    """
+    return '\0' + str(device) + ':' + str(inode)
+
+def mtime_ns(statResult):
+    """Returns st_mtime_ns, or the closest we can get to it"""
+    if hasattr(statResult, 'st_mtime_ns'):
+        return statResult.st_mtime_ns
+    return int(round(statResult.st_mtime * 1000000000))
+
+def under_prefixes(pathname, prefixes):
+    """Whether pathname is one of prefixes, or beneath one of them"""
+    for prefix in prefixes:
+        if pathname == prefix or pathname.startswith(prefix + '/'):
+            return True
+    return False
+
+def dead_key(item):
+    """Checks a (key, pathname, kind) item of gc_batches(), returning
+    whether its db entry no longer describes anything on disk
+    """
+    key, pathname, kind = item
+    try:
+        statResult=os.stat(pathname)
+    except (OSError, TypeError):
+        return True
+    if kind == 'dir':
+        return not stat.S_ISDIR(statResult.st_mode)
+    if kind == 'identity':
+        # an identity entry lives as long as the file it names
+        return identity_key(statResult.st_dev, statResult.st_ino) != key
+    return False
+
+def directory_key(pathname):
+    """Names the db entry holding a directory's digest.  Like identity keys
+    these start with a NUL, so they never collide with pathname keys.
+    """
+    return DIRECTORY_KEY + pathname
+
+def open_cache(databasePathname, mode='c'):
+    """Returns the hash cache named on the command line: a SqliteCache for
+    'sqlite:' pathnames, otherwise a GdbmCache.
+    """
+    if databasePathname.startswith('sqlite:'):
+        return SqliteCache(databasePathname[len('sqlite:'):])
+    return GdbmCache(databasePathname, mode)
+
+class GdbmCache:
+    """A hash cache kept in a gdbm file.  Each entry is stored twice, under
+    its pathname and under its identity key.  Only one process may have
+    the file open for writing.
+    """
+    def __init__(self, pathname, mode='c'):
+        try:
+            self.modTime = os.stat(pathname).st_mtime
+        except OSError:
+            print "# db " + pathname + " doesn't exist yet"
+            self.modTime = None
+
+        self.db = gdbm.open(pathname, mode)
+        self.pendingDeletes = None      # a temporary file, see delete()
+        if self.modTime == None:
+            self.modTime = time.time()
+
+        print '# db last modification time is ' + str(time.time() - self.modTime) + ' seconds ago'
+
+    def read(self, key):                        # GdbmCache.read
+        if key not in self.db:
+            return {}
+        return decode_cache_value(self.db[key])
+
+    def lookup(self, pathname):                 # GdbmCache.lookup
+        """Returns the entry stored for pathname, or an empty dict"""
+        return self.read(pathname)
+
+    def lookup_identity(self, device, inode):   # GdbmCache.lookup_identity
+        """Returns the entry last stored for this (device, inode)"""
+        return self.read(identity_key(device, inode))
+
+    def trusts_legacy(self, entry, modTime):    # GdbmCache.trusts_legacy
+        """Entries written before file metadata was cached are trusted if
+        the db is newer than the file, as they always were.
+        """
+        return len(entry) and 'mtime' not in entry and modTime <= self.modTime
+
+    def prefetch(self, dirnames):               # GdbmCache.prefetch
+        """Lookups are cheap enough here, nothing to do"""
+        pass
+
+    def lookup_dir(self, pathname):             # GdbmCache.lookup_dir
+        """Returns the directory entry stored for pathname, or an empty dict"""
+        return self.read(directory_key(pathname))
+
+    def prefetch_dirs(self, pathname):          # GdbmCache.prefetch_dirs
+        pass
+
+    def store_dir(self, pathname, entry):       # GdbmCache.store_dir
+        self.db[directory_key(pathname)]=encode_cache_value(entry)
+
+    def store(self, entry):                     # GdbmCache.store
+        value=encode_cache_value(entry)
+        self.db[entry['path']]=value
+        self.db[identity_key(entry['dev'], entry['ino'])]=value
+
+    def keys(self):                             # GdbmCache.keys
+        return self.db.keys()
+
+    def key_count(self):                        # GdbmCache.key_count
+        self.flush()
+        return len(self.db)
+
+    def gc_batches(self, prefixes, size):       # GdbmCache.gc_batches
+        """Yields lists of up to size (key, pathname, kind) items, one for
+        each key whose pathname is under prefixes (or every key, if there
+        are none).  gdbm keeps keys in hash order, so only each batch is
+        sorted.  Keys deleted meanwhile are only removed by flush(), as
+        deleting during a firstkey/nextkey walk can make it skip keys.
+        """
+        batch=[]
+        key=self.db.firstkey()
+        while key != None:
+            if key.startswith(DIRECTORY_KEY):
+                item=(key, key[len(DIRECTORY_KEY):], 'dir')
+            elif key.startswith('\0'):
+                item=(key, self.read(key).get('path'), 'identity')
+            else:
+                item=(key, key, 'path')
+            if len(prefixes) == 0 or (item[1] != None and under_prefixes(item[1], prefixes)):
+                batch.append(item)
+            if len(batch) >= size:
+                batch.sort(key=lambda item: item[1])
+                yield batch
+                batch=[]
+            key=self.db.nextkey(key)
+        if len(batch):
+            batch.sort(key=lambda item: item[1])
+            yield batch
+
+    def delete(self, key):                      # GdbmCache.delete
+        """Deletes key at the next flush(), see gc_batches.  Keys wait in
+        a temporary file, so memory stays flat however many there are.
+        """
+        if self.pendingDeletes == None:
+            self.pendingDeletes=tempfile.TemporaryFile(prefix='dedup-gc-')
+        marshal.dump(key, self.pendingDeletes)
+
+    def flush(self):                            # GdbmCache.flush
+        """Deletes the keys delete() spilled, reading them back one by one"""
+        if self.pendingDeletes == None:
+            return
+        pending=self.pendingDeletes
+        self.pendingDeletes=None
+        pending.seek(0)
+        while True:
+            try:
+                key=marshal.load(pending)
+            except EOFError:
+                break
+            if key in self.db:
+                del self.db[key]
+        pending.close()
+
+    def close(self, reorganize=False):          # GdbmCache.close
+        self.flush()
+        if reorganize:
+            self.db.reorganize()
+        self.db.sync()
+        self.db.close()
+
+class SqliteCache:
+    """A hash cache kept in a sqlite database.  Writes are committed in
+    batches of CACHE_BATCH and the database runs in WAL mode, so several
+    dedup processes can read and write one cache at the same time.
+    """
+    def __init__(self, pathname):
+        self.conn = sqlite3.connect(pathname, timeout=600, isolation_level=None)
+        self.conn.text_factory = str
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, dir TEXT, size INTEGER, mtime TEXT, ino INTEGER, dev INTEGER, digests TEXT)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS files_dir ON files (dir)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS files_identity ON files (dev, ino)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, digests TEXT)')
+        self.prefetched = {}
+        self.prefetchedDirs = set()
+        self.prefetchedTrees = {}
+        self.pendingWrites = {}
+        self.pendingDeletes = []
+        self.pendingDirWrites = {}
+        self.pendingDirDeletes = []
+
+    def row_entry(self, row):                   # SqliteCache.row_entry
+        """Turns a row of the files table back into a dict"""
+        path, size, mtime, ino, dev, digests = row
+        entry=decode_cache_value(digests)
+        entry['path']=path
+        entry['size']=str(size)
+        entry['mtime']=mtime
+        entry['ino']=str(ino)
+        entry['dev']=str(dev)
+        return entry
+
+    def lookup(self, pathname):                 # SqliteCache.lookup
+        """Returns the entry stored for pathname, or an empty dict"""
+        if pathname in self.pendingWrites:
+            return dict(self.pendingWrites[pathname])
+        if pathname in self.prefetched:
+            return self.prefetched.pop(pathname)
+        if os.path.dirname(pathname) in self.prefetchedDirs:
+            return {}
+        for row in self.conn.execute('SELECT path, size, mtime, ino, dev, digests FROM files WHERE path = ?', (pathname, )):
+            return self.row_entry(row)
+        return {}
+
+    def lookup_identity(self, device, inode):   # SqliteCache.lookup_identity
+        """Returns an entry stored for this (device, inode)"""
+        for row in self.conn.execute('SELECT path, size, mtime, ino, dev, digests FROM files WHERE dev = ? AND ino = ? LIMIT 1', (device, inode)):
+            return self.row_entry(row)
+        return {}
+
+    def trusts_legacy(self, entry, modTime):    # SqliteCache.trusts_legacy
+        """Every row holds file metadata, see import_database"""
+        return False
+
+    def prefetch(self, dirnames):               # SqliteCache.prefetch
+        """Loads every entry of the given directories with one query each,
+        so that lookups during hashing do not go back to the database.
+        """
+        for dirname in dirnames:
+            if dirname in self.prefetchedDirs:
+                continue
+            for row in self.conn.execute('SELECT path, size, mtime, ino, dev, digests FROM files WHERE dir = ?', (dirname, )):
+                self.prefetched[row[0]]=self.row_entry(row)
+            self.prefetchedDirs.add(dirname)
+
+    def store(self, entry):                     # SqliteCache.store
+        self.pendingWrites[entry['path']]=dict(entry)
+        if len(self.pendingWrites) >= CACHE_BATCH:
+            self.flush()
+
+    def lookup_dir(self, pathname):             # SqliteCache.lookup_dir
+        """Returns the directory entry stored for pathname, or an empty dict"""
+        if pathname in self.prefetchedTrees:
+            return self.prefetchedTrees.pop(pathname)
+        for row in self.conn.execute('SELECT digests FROM dirs WHERE path = ?', (pathname, )):
+            return decode_cache_value(row[0])
+        return {}
+
+    def prefetch_dirs(self, pathname):          # SqliteCache.prefetch_dirs
+        """Loads the entries of pathname and every directory beneath it with
+        one query, a range over the primary key ('0' follows '/')
+        """
+        for path, digests in self.conn.execute('SELECT path, digests FROM dirs WHERE path = ? OR (path >= ? AND path < ?)',
+                                               (pathname, pathname + '/', pathname + '0')):
+            self.prefetchedTrees[path]=decode_cache_value(digests)
+
+    def store_dir(self, pathname, entry):       # SqliteCache.store_dir
+        self.pendingDirWrites[pathname]=encode_cache_value(entry)
+        if len(self.pendingDirWrites) >= CACHE_BATCH:
+            self.flush()
+
+    def flush(self):                            # SqliteCache.flush
+        """Commits pending writes and deletes in one transaction"""
+        rows=[]
+        for path, entry in self.pendingWrites.iteritems():
+            digests={}
+            for k, v in entry.iteritems():
+                if k not in ('path', 'size', 'mtime', 'ino', 'dev'):
+                    digests[k]=v
+            rows.append((path, os.path.dirname(path), int(entry['size']), entry['mtime'], int(entry['ino']), int(entry['dev']), encode_cache_value(digests)))
+
+        self.conn.execute('BEGIN IMMEDIATE')
+        self.conn.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+        self.conn.executemany('DELETE FROM files WHERE path = ?', [ (p, ) for p in self.pendingDeletes ])
+        self.conn.executemany('INSERT OR REPLACE INTO dirs VALUES (?, ?)', self.pendingDirWrites.iteritems())
+        self.conn.executemany('DELETE FROM dirs WHERE path = ?', [ (p, ) for p in self.pendingDirDeletes ])
+        self.conn.execute('COMMIT')
+        self.pendingWrites={}
+        self.pendingDeletes=[]
+        self.pendingDirWrites={}
+        self.pendingDirDeletes=[]
+
+    def key_count(self):                        # SqliteCache.key_count
+        self.flush()
+        return self.conn.execute('SELECT (SELECT COUNT(*) FROM files) + (SELECT COUNT(*) FROM dirs)').fetchone()[0]
+
+    def gc_batches(self, prefixes, size):       # SqliteCache.gc_batches
+        """Yields lists of up to size (key, pathname, kind) items, in
+        pathname order, for the rows under prefixes (or every row, if there
+        are none).  Each batch is read from where the last one ended, so
+        rows may be deleted between batches.
+        """
+        for table, kind in (('files', 'path'), ('dirs', 'dir')):
+            if len(prefixes) == 0:
+                ranges=[ ('', None) ]
+            else:
+                ranges=[ (prefix, prefix + '0') for prefix in sorted(set(prefixes)) ]
+            for low, high in ranges:
+                last=None
+                while True:
+                    # '0' follows '/', so [prefix, prefix + '0') holds
+                    # prefix and all beneath it, along with some siblings
+                    # (prefix + '-', say) which under_prefixes() drops
+                    query='SELECT path FROM ' + table + ' WHERE path >= ?'
+                    args=[ low ]
+                    if high != None:
+                        query = query + ' AND path < ?'
+                        args.append(high)
+                    if last != None:
+                        query = query + ' AND path > ?'
+                        args.append(last)
+                    rows=self.conn.execute(query + ' ORDER BY path LIMIT ?', args + [ size ]).fetchall()
+                    if len(rows) == 0:
+                        break
+                    last=rows[-1][0]
+                    batch=[]
+                    for row in rows:
+                        if high == None or under_prefixes(row[0], [ low ]):
+                            if kind == 'dir':
+                                batch.append((directory_key(row[0]), row[0], kind))
+                            else:
+                                batch.append((row[0], row[0], kind))
+                    if len(batch):
+                        yield batch
+
+    def delete(self, key):                      # SqliteCache.delete
+        if key.startswith(DIRECTORY_KEY):
+            self.pendingDirDeletes.append(key[len(DIRECTORY_KEY):])
+        else:
+            self.pendingDeletes.append(key)
+        if len(self.pendingDeletes) + len(self.pendingDirDeletes) >= CACHE_BATCH:
+            self.flush()
+
+    def close(self, reorganize=False):          # SqliteCache.close
+        self.flush()
+        if reorganize:
+            self.conn.execute('VACUUM')
+        self.conn.close()
+
+class Stats:
+    """Counters, phase timings and live progress for the run.  Everything
+    is written to stderr, so the generated script on stdout stays clean.
+    """
+    def __init__(self):
+        self.counters={}
+        self.timings={}
+        self.phaseOrder=[]
+        self.showProgress=False
+        self.phase=None
+
+    def count(self, name, n=1):                 # Stats.count
+        self.counters[name]=self.counters.get(name, 0) + n
+
+    def begin(self, phase, totalBytes=None):    # Stats.begin
+        """Starts timing phase.  With totalBytes, progress includes an ETA."""
+        self.phase=phase
+        self.phaseStart=time.time()
+        self.lastShown=self.phaseStart
+        self.doneFiles=0
+        self.doneBytes=0
+        self.totalBytes=totalBytes
+
+    def advance(self, files, bytes):            # Stats.advance
+        """Notes progress through the current phase, and shows it"""
+        self.doneFiles = self.doneFiles + files
+        self.doneBytes = self.doneBytes + bytes
+        now=time.time()
+        if self.showProgress and now - self.lastShown >= PROGRESS_INTERVAL:
+            self.lastShown=now
+            self.show(now)
+
+    def show(self, now):                        # Stats.show
+        elapsed=max(now - self.phaseStart, 0.001)
+        rate=self.doneBytes / elapsed
+        line='# ' + self.phase + ': ' + str(self.doneFiles) + ' files, ' + format_bytes(self.doneBytes)
+        if self.totalBytes != None:
+            line = line + ' of ' + format_bytes(self.totalBytes) + ', ' + format_bytes(rate) + '/s'
+            if self.doneBytes * 100 >= self.totalBytes > 0:
+                # early rates say little about the rest
+                line = line + ', ETA ' + format_seconds((self.totalBytes - self.doneBytes) / rate)
+        if sys.stderr.isatty():
+            sys.stderr.write('\r' + line + '\033[K')
+        else:
+            sys.stderr.write(line + '\n')
+        sys.stderr.flush()
+
+    def end(self):                              # Stats.end
+        """Stops timing the current phase, adding to its total"""
+        if self.phase not in self.timings:
+            self.timings[self.phase]=0.0
+            self.phaseOrder.append(self.phase)
+        self.timings[self.phase] = self.timings[self.phase] + time.time() - self.phaseStart
+        if self.showProgress and sys.stderr.isatty():
+            sys.stderr.write('\r\033[K')
+        self.phase=None
+
+    def report(self):                           # Stats.report
+        """Writes the counters and phase timings"""
+        for name in sorted(self.counters.keys()):
+            sys.stderr.write('# ' + name + ': ' + str(self.counters[name]) + '\n')
+        for phase in self.phaseOrder:
+            sys.stderr.write('# ' + phase + ' took ' + format_seconds(self.timings[phase]) + '\n')
+
+stats=Stats()
+
 class EntryList:
     """A container for all source directories and files to examine"""
-    def __init__(self, arguments, databasePathname, staggerPaths):
+    def __init__(self, arguments, databasePathname, staggerPaths, fromManifest=False):
         self.contents = {}
-        self.modTime = None
         self.db = None
+        self.fileList = []
+        self.dirCount = 0
+        self.uniqueSizeBytes = 0        # bytes never read: nothing shares their size
+        self.sampledBytes = 0           # bytes never read: ruled out by prefilter
+        self.resumeMap = {}             # appended files, see FileObj.appended_chunks
         stagger=0;
 
-        if databasePathname != None:
-            try:
-                self.modTime = os.stat(databasePathname).st_mtime
-            except OSError:
-                print "# db " + databasePathname + " doesn't exist yet"
-                self.modTime = None
-
-            self.db = gdbm.open(databasePathname, 'c')
-            if self.modTime == None:
-                self.modTime = time.time()
+        if fromManifest:
+            # arguments are manifests, nothing here touches the tree itself
+            for entry in arguments:
+                weightAdjust, entry = check_level(entry)
+                stagger=self.load_manifest(entry, weightAdjust, staggerPaths, stagger)
+            self.find_links()
+            return
 
-            print '# db last modification time is ' + str(time.time() - self.modTime) + ' seconds ago'
+        if databasePathname != None:
+            self.db = open_cache(databasePathname)
 
         # walk arguments adding files and directories
+        stats.begin('scan')
+        nested=nested_arguments(arguments)
         for entry in arguments:
+            if entry in nested:
+                print '# Skipping ' + entry + ', it is part of ' + nested[entry]
+                continue
             # strip trailing slashes, they are not needed
             entry=entry.rstrip('/')
 
             # check if a weight has been provided for this argument
             weightAdjust, entry = check_level(entry)
 
-            if os.path.isfile(entry):
+            try:
+                statResult=os.stat(entry)
+            except OSError:
+                statResult=None
+
+            if statResult != None and stat.S_ISREG(statResult.st_mode):
                 if staggerPaths:
                     weightAdjust=weightAdjust + stagger
-                self.contents[entry]=FileObj(entry, dbTime=self.modTime, db=self.db, weightAdjust=weightAdjust)
+                self.contents[entry]=FileObj(entry, weightAdjust=weightAdjust, statResult=statResult)
+                self.fileList.append(self.contents[entry])
                 if staggerPaths:
                     stagger=stagger + self.contents[entry].depth
-            elif issocket(entry):
-                print '# Skipping a socket ' + entry
-            elif os.path.isdir(entry):
+            elif statResult != None and stat.S_ISDIR(statResult.st_mode):
                 if staggerPaths:
                     weightAdjust=weightAdjust + stagger
                 topDirEntry=DirObj(entry, weightAdjust)
                 self.contents[entry]=topDirEntry
-                for dirName, subdirList, fileList in os.walk(entry, topdown=False):
-                    dirEntry=topDirEntry.place_dir(dirName, weightAdjust)
-                    for fname in fileList:
-                        if issocket(dirEntry.pathname + '/' + fname):
-                            print '# Skipping a socket ' + dirEntry.pathname + '/' + fname
-                        else:
-                            dirEntry.files[fname]=FileObj(fname, parent=dirEntry, dbTime=self.modTime, db=self.db, weightAdjust=weightAdjust)
+                self.dirCount = self.dirCount + 1
+                self.scan_dir(topDirEntry, weightAdjust)
+                topDirEntry.tally()
                 if staggerPaths:
                     stagger=topDirEntry.max_depth()
+            elif statResult != None:
+                print '# Skipping a ' + describe_mode(statResult.st_mode) + ' ' + entry
             else:
                 print "I don't know what this is" + entry
                 sys.exit()
+        stats.end()
+
+        self.hash_candidates()
+        self.finalize_dirs()
         if self.db != None:
             self.db.close()
 
+    def finalize_dirs(self):            # EntryList.finalize_dirs
+        """Works out the digest of every directory, deepest first.  With a
+        db, digests computed before are reused while the directory's
+        change token still matches, see DirObj.finalize.
+        """
+        stats.begin('directory digests')
+        for name, e in self.contents.iteritems():
+            if isinstance(e, DirObj):
+                if self.db != None:
+                    self.db.prefetch_dirs(e.pathname)
+                for dirEntry in e.dirwalk():
+                    dirEntry.finalize(self.db)
+        stats.end()
+
+    def scan_dir(self, topDirEntry, weightAdjust):     # EntryList.scan_dir
+        """Builds the tree beneath topDirEntry, attaching each child directly
+        to its parent DirObj.  Each entry is stat'ed at most once, and that
+        stat result is what decides whether it is a file we can read.
+        """
+        pending=[ topDirEntry ]
+        while len(pending):
+            dirEntry=pending.pop()
+            relativePath=dirEntry.relative_path()
+            if relativePath != '':
+                relativePath = relativePath + '/'
+            skip=None
+            if len(excludeList):
+                def skip(name):
+                    if excluded(relativePath + name):
+                        if verbose:
+                            print '# Excluding ' + dirEntry.pathname + '/' + name
+                        dirEntry.filtered=True
+                        return True
+                    return False
+            try:
+                entries=list(scan_entries(dirEntry.pathname, skip))
+            except OSError:
+                # like os.walk, leave out directories we cannot list
+                print '# Skipping an unreadable directory ' + dirEntry.pathname
+                if dirEntry.parent != None:
+                    del dirEntry.parent.subdirs[dirEntry.name]
+                continue
+
+            for name, isDir, statResult in entries:
+                # the same few names turn up in directory after directory
+                name=intern(name)
+                if isDir:
+                    subdir=DirObj(name, weightAdjust, dirEntry)
+                    if dirEntry.subdirs is NO_CHILDREN:
+                        dirEntry.subdirs={}
+                    dirEntry.subdirs[name]=subdir
+                    pending.append(subdir)
+                    self.dirCount = self.dirCount + 1
+                elif statResult == None:
+                    print '# Skipping a dangling symlink ' + dirEntry.pathname + '/' + name
+                elif stat.S_ISREG(statResult.st_mode):
+                    if filtered_file(relativePath + name, statResult):
+                        if verbose:
+                            print '# Filtering out ' + dirEntry.pathname + '/' + name
+                        dirEntry.filtered=True
+                        continue
+                    if dirEntry.files is NO_CHILDREN:
+                        dirEntry.files={}
+                    dirEntry.files[name]=FileObj(name, parent=dirEntry, weightAdjust=weightAdjust, statResult=statResult)
+                    self.fileList.append(dirEntry.files[name])
+                elif not stat.S_ISDIR(statResult.st_mode):
+                    # symlinks to directories are skipped silently, as
+                    # os.walk never descends into them
+                    print '# Skipping a ' + describe_mode(statResult.st_mode) + ' ' + dirEntry.pathname + '/' + name
+            stats.advance(len(dirEntry.files), sum(f.bytes for f in dirEntry.files.itervalues()))
+
+    def hash_candidates(self):          # EntryList.hash_candidates
+        """Only files which share their size with another file can have a 
+        duplicate, so group everything by size and only read those.  Files
+        with a unique size get a synthetic digest instead.
+        """
+        # links to one inode share their contents, so only the first link
+        # we found is hashed and the others copy its digest afterwards
+        hashList=self.find_links()
+
+        sizeMap={}
+        for fileEntry in hashList:
+            if fileEntry.bytes in sizeMap:
+                sizeMap[fileEntry.bytes].append(fileEntry)
+            else:
+                sizeMap[fileEntry.bytes] = [ fileEntry ]
+
+        # the db is only ever touched from this thread, so cached values
+        # are gathered here before work is handed to the pool
+        cacheMap={}
+        sampleList=[]
+        fullList=[]
+        for size, candidates in sizeMap.iteritems():
+            if size == 0:
+                # empty files were given their digest at stat time
+                continue
+            if hashAll:
+                fullList.extend(candidates)
+            elif len(candidates) == 1:
+                candidates[0].set_unique()
+                self.uniqueSizeBytes = self.uniqueSizeBytes + size
+            elif size > SAMPLE_SIZE * (SAMPLE_COUNT + 2):
+                sampleList.extend(candidates)
+            else:
+                fullList.extend(candidates)
+
+        fullList.extend(self.prefilter(sampleList, cacheMap))
+
+        hashedBytes=0
+        digests=self.fetch(fullList, 'digest', cacheMap)
+        for fileEntry in fullList:
+            fileEntry.digest=binascii.unhexlify(digests[fileEntry])
+            hashedBytes = hashedBytes + fileEntry.bytes
+        self.confirm_resumed(fullList, cacheMap)
+
+        print '# ' + str(len(fullList)) + ' of ' + str(len(self.fileList)) + ' files needed a full hash (' + str(hashedBytes) + ' bytes)'
+
+        if verifyContents:
+            self.verify(fullList)
+
+        linkCount=0
+        for links in self.linkGroups:
+            for fileEntry in links[1:]:
+                fileEntry.digest=links[0].digest
+                linkCount = linkCount + 1
+        if linkCount:
+            print '# ' + str(linkCount) + ' files were not read, they share an inode with a file that was'
+
+    def confirm_resumed(self, candidates, cacheMap):  # EntryList.confirm_resumed
+        """Digests resumed after an append trust the chunks they did not
+        read again, so they must never be the only evidence for a deletion.
+        Those shared with another file are read again in full.  The rest
+        can only match a copy elsewhere through a file sharing them, so
+        they decide nothing.
+        """
+        digestCounts={}
+        for fileEntry in candidates:
+            digestCounts[fileEntry.digest]=digestCounts.get(fileEntry.digest, 0) + 1
+        suspects=[ f for f in candidates if f in self.resumeMap and digestCounts[f.digest] > 1 ]
+        if len(suspects) == 0:
+            return
+
+        stats.begin('confirming resumed digests', sum(f.bytes for f in suspects))
+        for fileEntry, (value, chunks) in scheduled_map(lambda fileEntry: fileEntry.read_digest(), suspects):
+            stats.advance(1, fileEntry.bytes)
+            stats.count('resumed digests confirmed by a full read')
+            fileEntry.digest=binascii.unhexlify(value)
+            del self.resumeMap[fileEntry]
+            if self.db != None:
+                cacheMap[fileEntry][cache_field('digest', fileEntry.bytes)]=value
+                cacheMap[fileEntry][cache_field('chunks')]=','.join(chunks)
+                fileEntry.store_cache_entry(self.db, cacheMap[fileEntry])
+        stats.end()
+
+    def verify(self, candidates):       # EntryList.verify
+        """Compares the contents of files sharing a digest, group by group
+        across the worker pool.  Files which turn out to differ are given
+        a synthetic digest of their own, so they are never deleted in
+        favour of each other.
+        """
+        digestMap={}
+        for fileEntry in candidates:
+            if fileEntry.digest in digestMap:
+                digestMap[fileEntry.digest].append(fileEntry)
+            else:
+                digestMap[fileEntry.digest] = [ fileEntry ]
+        groupList=[ members for members in digestMap.itervalues() if len(members) > 1 ]
+
+        stats.begin('verifying', sum(members[0].bytes * len(members) for members in groupList))
+        start=time.time()
+        verifiedBytes=0
+        for members, (groups, bytesRead) in zip(groupList, parallel_map(verify_group, groupList)):
+            stats.advance(len(members), bytesRead)
+            verifiedBytes = verifiedBytes + bytesRead
+            if len(groups) == 1:
+                stats.count('groups verified')
+                continue
+            stats.count('groups which diverged')
+            print '# ' + binascii.hexlify(members[0].digest) + ' is shared by ' + str(len(groups)) + ' different contents:'
+            # the group holding the first member keeps the digest
+            position=dict((members[i], i) for i in xrange(len(members)))
+            groups.sort(key=lambda group: min(position[f] for f in group))
+            for i in xrange(len(groups)):
+                for fileEntry in groups[i]:
+                    print '#      ' + str(i) + ' ' + fileEntry.pathname
+                    if i > 0:
+                        fileEntry.digest='diverged:' + str(i) + ':' + fileEntry.digest
+        stats.end()
+        elapsed=max(time.time() - start, 0.001)
+        sys.stderr.write('# verified ' + format_bytes(verifiedBytes) + ' in ' + format_seconds(elapsed) +
+                         ' (' + format_bytes(verifiedBytes / elapsed) + '/s)\n')
+
+    def find_links(self):               # EntryList.find_links
+        """Groups the files sharing an inode into linkGroups, whatever
+        their link count: hardlinks, and files reached twice through a
+        symlink.  Returns every file, less all but the first of each group.
+        """
+        inodeMap={}
+        firstLinks=[]
+        for fileEntry in self.fileList:
+            if fileEntry.inode != 0:
+                key=(fileEntry.device, fileEntry.inode)
+                if key in inodeMap:
+                    inodeMap[key].append(fileEntry)
+                    continue
+                inodeMap[key] = [ fileEntry ]
+            firstLinks.append(fileEntry)
+        self.linkMap=dict((key, links) for key, links in inodeMap.iteritems() if len(links) > 1)
+        self.linkGroups=self.linkMap.values()
+        self.freedInodes=set()          # see freed_bytes
+        return firstLinks
+
+    def shares_inode(self, fileEntry):  # EntryList.shares_inode
+        """Whether fileEntry has other links, or was found under other names"""
+        return fileEntry.is_hardlinked() or (fileEntry.device, fileEntry.inode) in self.linkMap
+
+    def freed_bytes(self, fileEntry):   # EntryList.freed_bytes
+        """Bytes the deletion of fileEntry frees, as count_deleted_bytes
+        counts them.  A file sharing its inode frees its space once, when
+        every link to it (including those outside our paths) is deleted.
+        """
+        if not self.shares_inode(fileEntry):
+            return fileEntry.bytes
+        key=(fileEntry.device, fileEntry.inode)
+        if key in self.freedInodes:
+            return 0
+        deletedLinks=len([ f for f in self.linkMap.get(key, [ fileEntry ]) if f.deleted ])
+        if deletedLinks < fileEntry.links:
+            return 0
+        self.freedInodes.add(key)
+        return fileEntry.bytes
+
+    def write_manifest(self, pathname): # EntryList.write_manifest
+        """Writes what was scanned to pathname as a stream of marshal records:
+        a (tag, version, hash, host) header, then for each argument a ('t', name, weight, isDir) record
+        followed by its directories, each just before its files:
+            ('d', relative path)
+            ('x', relative path)    if the directory had contents filtered out
+            ('f', relative path, size, mtime, inode, device, links, digest)
+        A manifest can stand in for its paths with --from-manifest.
+        """
+        with open(pathname, 'wb') as f:
+            marshal.dump((MANIFEST_TAG, MANIFEST_VERSION, hashName, socket.gethostname()), f)
+            for name, e in self.contents.iteritems():
+                if isinstance(e, FileObj):
+                    marshal.dump(('t', name, e.depth, False), f)
+                    marshal.dump(e.manifest_record(''), f)
+                    continue
+                marshal.dump(('t', name, e.depth - len(name.split('/')), True), f)
+                for dirEntry in e.dirwalk(topdown=True):
+                    relativePath=dirEntry.pathname[len(name)+1:]
+                    if dirEntry is not e:
+                        marshal.dump(('d', relativePath), f)
+                    if dirEntry.filtered:
+                        marshal.dump(('x', relativePath), f)
+                    if dirEntry is not e:
+                        relativePath = relativePath + '/'
+                    for fileName, fileEntry in dirEntry.files.iteritems():
+                        marshal.dump(fileEntry.manifest_record(relativePath + fileName), f)
+
+    def load_manifest(self, pathname, weightAdjust, staggerPaths, stagger):  # EntryList.load_manifest
+        """Adds the trees recorded at pathname by write_manifest() as if
+        they had been scanned here, weighted by weightAdjust on top of
+        the weights they were scanned with.  Returns the new stagger.
+        """
+        records=read_records(pathname)
+        try:
+            header=next(records, None)
+        except (ValueError, TypeError):
+            header=None
+        if not isinstance(header, tuple) or len(header) != 4 or header[0] != MANIFEST_TAG:
+            print '# ' + pathname + ' is not a dedup manifest'
+            sys.exit(-1)
+        # version 2 differs only in lacking 'x' records
+        if header[1] not in (2, MANIFEST_VERSION):
+            print '# ' + pathname + ' is a version ' + str(header[1]) + ' manifest, expected ' + str(MANIFEST_VERSION)
+            sys.exit(-1)
+        if header[2] != hashName:
+            print '# ' + pathname + ' holds ' + header[2] + ' digests, use --hash ' + header[2]
+            sys.exit(-1)
+        # device numbers mean nothing from one host to the next, so links
+        # are only recognized between manifests of the same host
+        host=header[3]
+
+        top=None
+        for record in records:
+            if record[0] == 't':
+                stagger=self.finish_loaded(top, staggerPaths, stagger)
+                name, topWeight, isDir = record[1:]
+                if name in self.contents:
+                    print '# ' + name + ' is in more than one manifest, scan them under different paths'
+                    sys.exit(-1)
+                topWeight = topWeight + weightAdjust
+                if staggerPaths:
+                    topWeight = topWeight + stagger
+                top=None
+                if isDir:
+                    top=DirObj(name, topWeight)
+                    self.contents[name]=top
+                    self.dirCount = self.dirCount + 1
+                    dirMap={ '': top }
+            elif record[0] == 'd':
+                parentPath, slash, dirName = record[1].rpartition('/')
+                parent=dirMap[parentPath]
+                dirEntry=DirObj(intern(dirName), 0, parent)
+                if parent.subdirs is NO_CHILDREN:
+                    parent.subdirs={}
+                parent.subdirs[dirEntry.name]=dirEntry
+                dirMap[record[1]]=dirEntry
+                self.dirCount = self.dirCount + 1
+            elif record[0] == 'x':
+                dirMap[record[1]].filtered=True
+            else:
+                relativePath, size, mtime, inode, device, links, digest = record[1:]
+                statResult=os.stat_result((stat.S_IFREG, inode, (host, device),
+                                           links, 0, 0, size, 0, mtime / 1000000000.0, 0))
+                if relativePath == '':
+                    top=FileObj(name, weightAdjust=topWeight, statResult=statResult)
+                    fileEntry=top
+                    self.contents[name]=top
+                else:
+                    parentPath, slash, fileName = relativePath.rpartition('/')
+                    parent=dirMap[parentPath]
+                    fileEntry=FileObj(intern(fileName), parent=parent, statResult=statResult)
+                    if parent.files is NO_CHILDREN:
+                        parent.files={}
+                    parent.files[fileEntry.name]=fileEntry
+                fileEntry.mtime=mtime
+                fileEntry.digest=digest
+                self.fileList.append(fileEntry)
+        return self.finish_loaded(top, staggerPaths, stagger)
+
+    def finish_loaded(self, top, staggerPaths, stagger):    # EntryList.finish_loaded
+        """Once a loaded argument is complete, tallies it and staggers the
+        next one past it, as __init__ does for scanned arguments
+        """
+        if isinstance(top, DirObj):
+            top.tally()
+            if staggerPaths:
+                stagger=top.max_depth()
+        elif isinstance(top, FileObj):
+            if staggerPaths:
+                stagger=stagger + top.depth
+        return stagger
+
+    def prefilter(self, candidates, cacheMap):  # EntryList.prefilter
+        """Fingerprint a few blocks of each same-sized candidate and only
+        return those whose fingerprint collides with another candidate.
+        The rest are given a synthetic digest without being read in full.
+        """
+        samples=self.fetch(candidates, 'sample', cacheMap)
+        sampleMap={}
+        for fileEntry in candidates:
+            key=(fileEntry.bytes, samples[fileEntry])
+            if key in sampleMap:
+                sampleMap[key].append(fileEntry)
+            else:
+                sampleMap[key] = [ fileEntry ]
+
+        survivors=[]
+        for (size, sample), sampleList in sampleMap.iteritems():
+            if len(sampleList) == 1:
+                fileEntry=sampleList[0]
+                fileEntry.set_unique(sample)
+                self.sampledBytes = self.sampledBytes + fileEntry.bytes - SAMPLE_SIZE * (SAMPLE_COUNT + 2)
+            else:
+                survivors.extend(sampleList)
+        return survivors
+
+    def fetch(self, candidates, field, cacheMap):   # EntryList.fetch
+        """Returns a dict of FileObj to 'sample' or 'digest' values.  Values
+        are taken from the db when they can be trusted, the rest are read by
+        the worker pool.  New values are written back from this thread only.
+        """
+        values={}
+        pending=[]
+        if self.db != None:
+            self.db.prefetch(set([ os.path.dirname(f.pathname) for f in candidates if f not in cacheMap ]))
+        for fileEntry in candidates:
+            if fileEntry not in cacheMap:
+                cacheMap[fileEntry]=fileEntry.cached_entry(self.db, self.resumeMap)
+            entry=cacheMap[fileEntry]
+            key=cache_field(field, fileEntry.bytes)
+            if key in entry:
+                if verbose:
+                    print '# ' + fileEntry.pathname + ' ' + field + ' already in db'
+                if self.db != None:
+                    stats.count('cache hits (' + field + ')')
+                values[fileEntry]=entry[key]
+                if entry.get('path') != fileEntry.pathname:
+                    # found by identity after a rename, or an old style
+                    # entry: store it again under the current metadata
+                    fileEntry.store_cache_entry(self.db, entry)
+            else:
+                if self.db != None:
+                    stats.count('cache misses (' + field + ')')
+                pending.append(fileEntry)
+
+        if field == 'sample':
+            reader=lambda fileEntry: (fileEntry.read_sample(), None)
+            readBytes=lambda fileEntry: SAMPLE_SIZE * (SAMPLE_COUNT + 2)
+        else:
+            reader=lambda fileEntry: fileEntry.read_digest(self.resumeMap.get(fileEntry))
+            readBytes=lambda fileEntry: fileEntry.bytes
+
+        stats.begin(field + ' hashing', sum(readBytes(f) for f in pending))
+        for fileEntry, (value, chunks) in scheduled_map(reader, pending):
+            stats.advance(1, readBytes(fileEntry))
+            values[fileEntry]=value
+            if verbose:
+                print '# computed new ' + field + ' for ' + fileEntry.pathname
+            if field == 'digest' and chunks != None and fileEntry in self.resumeMap and \
+               chunks[:len(self.resumeMap[fileEntry][1]) - 1] != self.resumeMap[fileEntry][1][:-1]:
+                # a resumed digest keeps the old records of the chunks
+                # before the last, so this one started over: it is exact
+                del self.resumeMap[fileEntry]
+            if self.db != None:
+                # add/update the cached value for this entry.  resumed
+                # digests are not kept, as nothing has confirmed them
+                if field != 'digest' or fileEntry not in self.resumeMap:
+                    cacheMap[fileEntry][cache_field(field, fileEntry.bytes)]=value
+                if chunks != None:
+                    cacheMap[fileEntry][cache_field('chunks')]=','.join(chunks)
+                fileEntry.store_cache_entry(self.db, cacheMap[fileEntry])
+        stats.end()
+        return values
+
     def count_deleted_bytes(self):      # EntryList.count_deleted_bytes
-        """Returns a count of all the sizes of the deleted objects within"""
+        """Returns a count of all the sizes of the deleted objects within.
+        A hardlinked file only frees its space once every link to it is
+        deleted, including links outside the paths we were given.
+        """
         bytes=0
         for name, e in self.contents.iteritems():
             bytes = bytes + e.count_deleted_bytes()
+        for links in self.linkGroups:
+            deletedLinks=len([ f for f in links if f.deleted ])
+            if deletedLinks:
+                bytes = bytes - links[0].bytes * deletedLinks
+                if deletedLinks >= links[0].links:
+                    bytes = bytes + links[0].bytes
         return bytes
 
     def count_deleted(self):            # EntryList.count_deleted
@@ -172,54 +1589,79 @@ class EntryList:
             count = count + e.count_deleted()
         return count
 
-    def prune_empty(self):              # EntryList.prune_empty
-        """Crawls through all directories and deletes the children of the deleted"""
+    def prune_empty(self, pruned=None): # EntryList.prune_empty
+        """Crawls through all directories and deletes the children of the deleted.
+        Directories marked here are appended to 'pruned', if it is given.
+        """
         prevCount = self.count_deleted()
-        for name, e in allFiles.contents.iteritems():
-            e.prune_empty()
-        return allFiles.count_deleted() - prevCount
+        for name, e in self.contents.iteritems():
+            e.prune_empty(pruned)
+        return self.count_deleted() - prevCount
+
+    def lookup(self, topName, relativePath):    # EntryList.lookup
+        """Returns the entry at relativePath beneath the top level entry topName"""
+        entry=self.contents[topName]
+        if relativePath == '':
+            return entry
+        names=relativePath.split('/')
+        for name in names[:-1]:
+            entry=entry.subdirs[name]
+        if names[-1] in entry.subdirs:
+            return entry.subdirs[names[-1]]
+        return entry.files[names[-1]]
 
     def walk(self):                     # EntryList.walk
-        for name, topLevelItem in allFiles.contents.iteritems():
+        for name, topLevelItem in self.contents.iteritems():
             for item in topLevelItem.walk():
                 yield item
 
-    def generate_commands(self):        # EntryList.generate_commands
-        """Generates delete commands to dedup all contents"""
-
+    def plan(self):                     # EntryList.plan
+        """Returns the resolved plan as four maps: winning directories to
+        the directories they make redundant, winning files to redundant
+        files, kept files to the other names of their inode which are kept
+        too (nothing is deleted for them), and directories left empty (to
+        True).  Keys and values are entries.
+        """
         selectDirMap={}
         selectFileMap={}
+        linkMap={}
         emptyMap={}
 
-        # TODO file removals should be grouped by the winner for better reviewing
         for name, e in self.contents.iteritems():
-            e.generate_commands(selectDirMap, selectFileMap, emptyMap)
+            e.generate_commands(selectDirMap, selectFileMap, linkMap, emptyMap)
+        for links in self.linkGroups:
+            kept=sorted([ f for f in links if not f.deleted and not f.ignore ], key=lambda e: e.pathname)
+            if len(kept) > 1:
+                linkMap[kept[0]]=kept[1:]
+        return selectDirMap, selectFileMap, linkMap, emptyMap
 
-        winnerList=selectDirMap.keys()
-        if len(winnerList):
+    def generate_commands(self):        # EntryList.generate_commands
+        """Generates delete commands to dedup all contents"""
+        selectDirMap, selectFileMap, linkMap, emptyMap = self.plan()
+
+        for winnerMap, title in ((selectDirMap, 'redundant directories'),
+                                 (selectFileMap, 'redundant files')):
+            if len(winnerMap):
+                print '####################################################################'
+                print '# ' + title + ':'
+                for winner in sorted(winnerMap.keys(), key=lambda e: e.pathname):
+                    print "#      '" + winner.pathname + "'"
+                    for loser in winnerMap[winner]:
+                        generate_delete(loser.pathname)
+                    print
+
+        if len(linkMap):
+            # deleting one of these names frees nothing, and may delete the
+            # others along with it when they are reached through a symlink
             print '####################################################################'
-            print '# redundant directories:'
-            winnerList.sort()
-            for winner in winnerList:
-                losers=selectDirMap[winner]
-                print "#      '" + winner + "'"
-                for loser in losers:
-                    generate_delete(loser)
+            print '# names of one file (hardlinks or symlinks), all kept:'
+            for first in sorted(linkMap.keys(), key=lambda e: e.pathname):
+                print "#      '" + first.pathname + "'"
+                for other in linkMap[first]:
+                    print "#      '" + other.pathname + "'"
                 print
 
-        winnerList=selectFileMap.keys()
-        if len(winnerList):
-            print '####################################################################'
-            print '# redundant files:'
-            winnerList.sort()
-            for winner in winnerList:
-                losers=selectFileMap[winner]
-                print "#      '" + winner + "'"
-                for loser in losers:
-                    generate_delete(loser)
-                print
-        
-        emptyDirs=emptyMap.keys()
+        emptyDirs=[ e.pathname for e in emptyMap.iterkeys() ]
         if len(emptyDirs):
             print '####################################################################'
             print '# directories that are or will be empty after resolving duplicates:'
@@ -229,13 +1671,27 @@ class EntryList:
 
 class HashMap:
     """A wrapper to a python dict with some helper functions"""
-    def __init__(self,allFiles):
+    def __init__(self, allFiles, spillDir=None):
         self.contentHash = {}
         self.minDepth = 1
         self.maxDepth = 0
         self.allFiles=allFiles # we will use this later to count deletions
-
-        for name, e in allFiles.contents.iteritems():
+        self.changed=set()     # digests of lists which lost entries
+        self.position=None     # set by the first resolve()
+
+        # with a spillDir, entries are written out in sorted runs rather
+        # than kept in contentHash, see spill() and merge_runs()
+        self.spillDir=None
+        if spillDir != None:
+            self.spillDir=tempfile.mkdtemp(prefix='dedup-', dir=spillDir)
+        self.run=[]
+        self.runFiles=[]
+        self.sequence=0
+        self.topNames=allFiles.contents.keys()
+
+        for topIndex in xrange(len(self.topNames)):
+            self.topIndex=topIndex
+            e=allFiles.contents[self.topNames[topIndex]]
             if isinstance(e, FileObj):
                 self.add_entry(e)
             else:
@@ -249,28 +1705,88 @@ class HashMap:
                             else:
                                 #print '# skipping deleted file ' + fileEntry.pathname
                                 pass
-                        dirEntry.finalize()
+                        if dirEntry.digest == None:
+                            dirEntry.finalize()
                         self.add_entry(dirEntry)
                         #print '# added dir ' + dirEntry.pathname
                     else:
                         #print '# skipping deleted dir ' + dirEntry.pathname
-                        pass
+                        # its digest still goes into its parent's
+                        if dirEntry.digest == None:
+                            dirEntry.finalize()
 
             maxd=e.max_depth()
             if self.maxDepth < maxd:
                 self.maxDepth=maxd
 
+        if self.spillDir != None:
+            self.merge_runs()
+
     def add_entry(self, entry):                 # Hashmap.add_entry
         """Store a file or directory in the HashMap, indexed by it's hash"""
 
-        if entry.hexdigest in self.contentHash:
-            self.contentHash[entry.hexdigest].append(entry)
-        else:
-            self.contentHash[entry.hexdigest] = [ entry ]
-
         if entry.depth < self.minDepth:
             self.minDepth = entry.depth
 
+        if self.spillDir != None:
+            self.spill(entry)
+            return
+
+        if entry.digest in self.contentHash:
+            self.contentHash[entry.digest].append(entry)
+        else:
+            self.contentHash[entry.digest] = [ entry ]
+
+    def spill(self, entry):                     # HashMap.spill
+        """Queue a (digest, sequence, top level entry, relative path) record,
+        writing the queue out as a sorted run once it holds SPILL_RECORDS.
+        The sequence number keeps entries of a digest in the order they
+        would have been appended to contentHash.
+        """
+        topName=self.topNames[self.topIndex]
+        relativePath=entry.pathname[len(topName)+1:]
+        self.run.append((entry.digest, self.sequence, self.topIndex, relativePath))
+        self.sequence = self.sequence + 1
+        if len(self.run) >= SPILL_RECORDS:
+            self.write_run()
+
+    def write_run(self):                        # HashMap.write_run
+        self.run.sort()
+        runFile=os.path.join(self.spillDir, 'run' + str(len(self.runFiles)))
+        with open(runFile, 'wb') as f:
+            for record in self.run:
+                marshal.dump(record, f)
+        self.runFiles.append(runFile)
+        self.run=[]
+
+    def merge_runs(self):                       # HashMap.merge_runs
+        """Merge the sorted runs and keep only the digests shared by two or
+        more entries, so memory is spent on collisions alone
+        """
+        if len(self.run):
+            self.write_run()
+
+        readers=[ read_records(runFile) for runFile in self.runFiles ]
+        group=[]
+        for record in heapq.merge(*readers):
+            if len(group) and group[0][0] != record[0]:
+                self.keep_group(group)
+                group=[]
+            group.append(record)
+        self.keep_group(group)
+
+        shutil.rmtree(self.spillDir)
+        self.spillDir=None
+
+    def keep_group(self, group):                # HashMap.keep_group
+        """Find the entries of a merged group and store them, if they collide"""
+        if len(group) < 2:
+            return
+        list=[]
+        for digest, sequence, topIndex, relativePath in group:
+            list.append(self.allFiles.lookup(self.topNames[topIndex], relativePath))
+        self.contentHash[group[0][0]]=list
+
     def display(self):                          # Hashmap.display
         """Generate a human readable report."""
         for hashval, list in self.contentHash.iteritems():
@@ -278,26 +1794,22 @@ class HashMap:
                 entry.display(False, False)
 
     def delete(self, entry):                    # Hashmap.delete
-        """Marks an entry as deleted then remove it from the HashMap"""
-
+        """Marks an entry as deleted.  Deleted entries (including the
+        children of a deleted directory) are dropped from their lists
+        lazily, so this only notes which lists have changed.
+        """
         entry.delete()
+        touched=set([ e.digest for e in entry.walk() ])
+        self.changed.update(touched)
+        return touched
 
-        # remove the entry from the hashmap
-        list=self.contentHash[entry.hexdigest]
-        newlist = []
-        for e in list:
-            if e != entry:
-                newlist.append(e)
-
-        # if there are no more entries for this hashval, remove
-        # it from the dictionary m
-        if len(newlist):
-            self.contentHash[entry.hexdigest] = newlist
-        else:
-            del self.contentHash[entry.hashval]
-
-        # also remove all the deleted children from the hashmap
-        self.prune()
+    def note_deleted(self, entries):            # HashMap.note_deleted
+        """Tells the HashMap about entries deleted behind its back (by
+        prune_empty) so the next resolve() looks at their lists again
+        """
+        for entry in entries:
+            for e in entry.walk():
+                self.changed.add(e.digest)
 
     def prune(self):                            # HashMap.prune
         """Removes deleted objects from the HashMap"""
@@ -308,73 +1820,187 @@ class HashMap:
                     newlist.append(entry)
             self.contentHash[hashval]=newlist
 
+    def live(self, hashval):                    # HashMap.live
+        """Returns the entries for hashval which are not deleted yet"""
+        list=self.contentHash[hashval]
+        if any(e.deleted for e in list):
+            list=[ e for e in list if not e.deleted ]
+            self.contentHash[hashval]=list
+        return list
+
+    def schedule(self, queue, hashval, depth):  # HashMap.schedule
+        """Queues hashval to be looked at once the sweep reaches its
+        shallowest live candidate (but no sooner than depth)
+        """
+        list=self.live(hashval)
+        if len(list) > 1:
+            minDepth=min(e.depth for e in list)
+            heapq.heappush(queue, (max(minDepth, depth), self.position[hashval]))
+
     def resolve(self):                          # HashMap.resolve
-        """Compares all entries and where hash collisions exists, pick a keeper"""
+        """Compares all entries and where hash collisions exists, pick a keeper.
+
+        Directories are resolved in order of increasing depth, then files.
+        Rather than rescanning every list at every depth, each list sits in
+        a queue keyed by (depth of its shallowest live candidate, position).
+        Popping the queue visits lists in the order a depth-by-depth sweep
+        over the whole dict would, skipping the visits that cannot change
+        anything.  Deletions requeue only the lists they touched.
+
+        The HashMap is kept from pass to pass.  A list left unresolved by one
+        pass (its winner is an empty directory) stays unresolved until it
+        loses an entry, so later passes only look at lists which changed.
+        """
         prevCount = self.allFiles.count_deleted()
 
-        # no need to resolve uniques, so remove them from the HashMap
-        deleteList=[]
-        for hashval, list in self.contentHash.iteritems():
-            if len(list) == 1:
-                deleteList.append(hashval)
-        for e in deleteList:
-            del self.contentHash[e]
+        if self.position == None:
+            # no need to resolve uniques, so remove them from the HashMap
+            deleteList=[]
+            for hashval, list in self.contentHash.iteritems():
+                if len(list) == 1:
+                    deleteList.append(hashval)
+            for e in deleteList:
+                del self.contentHash[e]
+
+            # position of each list in a sweep over the dict, in digest
+            # order so that merged runs sweep the same way:
+            self.order=sorted(self.contentHash.keys())
+            self.position={}
+            for i in xrange(len(self.order)):
+                self.position[self.order[i]]=i
+            dirty=self.order
+        else:
+            dirty=[ h for h in self.changed if h in self.position ]
+            dirty.sort(key=self.position.get)
+        self.changed=set()
+        order=self.order
 
         # delete the directories first, in order of
         # increasing depth
         if verbose:
             print '# checking candidates from depth ' + str(self.minDepth) + ' through ' + str(self.maxDepth)
-        for currentDepth in xrange(self.minDepth-1,self.maxDepth+1):
-            for hashval, list in self.contentHash.iteritems():
-                example = list[0]
-                if isinstance(example, DirObj):
-                    winner, losers = resolve_candidates(list, currentDepth)
-                    if losers != None:
-                        for loser in losers:
-                            if not loser.deleted:
-                                if verbose:
-                                    print '# dir "' + loser.pathname + '" covered by "' + winner.pathname + '"'
-                                self.delete(loser)
-                                loser.winner = winner
-                        self.prune()
-
-        for hashval, list in self.contentHash.iteritems():
-            example = list[0]  
-            if isinstance(example, FileObj):
-                winner, losers = resolve_candidates(list)
-                for loser in losers:
-                    if not loser.deleted:
-                        if verbose:
-                            print '# file "' + loser.pathname + '" covered by "' + winner.pathname + '"'
-                        self.delete(loser)
-                        loser.winner = winner
+        queue=[]
+        for hashval in dirty:
+            self.schedule(queue, hashval, self.minDepth-1)
+
+        while len(queue):
+            currentDepth, position = heapq.heappop(queue)
+            if currentDepth > self.maxDepth:
+                break
+            hashval=order[position]
+            list=self.live(hashval)
+            if len(list) < 2 or not isinstance(list[0], DirObj):
+                # nothing left to resolve, or left for the file pass
+                continue
+            winner, losers = resolve_candidates(list, currentDepth)
+            if losers == None:
+                continue
+            touched=set()
+            deleted=[]
+            for loser in losers:
+                if not loser.deleted:
+                    if verbose:
+                        print '# dir "' + loser.pathname + '" covered by "' + winner.pathname + '"'
+                    touched.update(self.delete(loser))
+                    loser.winner = winner
+                    deleted.append(loser)
+            if len(deleted):
+                emit_group(self.allFiles, winner, deleted, 'duplicate directory')
+            for changedHash in touched:
+                if changedHash not in self.position:
+                    continue
+                if self.position[changedHash] > position:
+                    # still ahead of us in this sweep
+                    self.schedule(queue, changedHash, currentDepth)
+                else:
+                    self.schedule(queue, changedHash, currentDepth+1)
+
+        dirty=set(dirty)
+        dirty.update([ h for h in self.changed if h in self.position ])
+        dirty=sorted(dirty, key=self.position.get)
+        for hashval in dirty:
+            list=self.live(hashval)
+            if len(list) < 2 or not isinstance(list[0], FileObj):
+                continue
+            winner, losers = resolve_candidates(list)
+            if losers == None:
+                continue
+            deleted=[]
+            for loser in losers:
+                if loser.same_file(winner):
+                    # one file under two names, whatever its link count:
+                    # deleting either name never frees anything, and
+                    # through a symlink it deletes the winner itself
+                    continue
+                if not loser.deleted:
+                    if verbose:
+                        print '# file "' + loser.pathname + '" covered by "' + winner.pathname + '"'
+                    if loser.bytes != winner.bytes:
+                        print '# BIRTHDAY CRISIS! matched hashes and mismatched sizes!'
+                        sys.exit(-1)
+                    self.delete(loser)
+                    loser.winner = winner
+                    if not loser.ignore:
+                        # like generate_commands, leave ignored files be
+                        deleted.append(loser)
+            if len(deleted):
+                emit_group(self.allFiles, winner, deleted, 'duplicate file')
 
         return self.allFiles.count_deleted() - prevCount
 
-class DirObj():
+class DirObj(object):
     """A directory object which can hold metadata and references to files and subdirectories"""
+    __slots__ = ('name', 'parent', 'files', 'subdirs', 'deleted', 'winner', 'depth',
+                 'ignore', 'digest', 'liveCount', 'totalCount', 'totalBytes',
+                 'deletedCount', 'deletedBytes', 'filtered')
+
     def __init__(self, name, weightAdjust=0, parent=None):
         self.name=name
-        self.files={}
+        self.files=NO_CHILDREN          # replaced by a dict once we have some
         self.deleted=False
         self.winner = None
-        self.subdirs={}
-        self.weightAdjust=weightAdjust
+        self.subdirs=NO_CHILDREN
+        self.digest=None
+        # subtree counters, see tally():
+        self.liveCount=0        # children keeping us from being empty
+        self.totalCount=1       # entries in our subtree, ourselves included
+        self.totalBytes=0       # bytes of the files in our subtree
+        self.deletedCount=0
+        self.deletedBytes=0
+        # some of our contents were left out by --exclude, --include or the
+        # size limits, so we are neither empty nor a copy of anything
+        self.filtered=False
         self.parent=parent
-        ancestry=self.get_lineage()
-        self.pathname='/'.join(ancestry) 
-        self.depth=len(ancestry) + self.weightAdjust
+        if self.parent == None:
+            self.depth=len(self.name.split('/')) + weightAdjust
+        else:
+            self.depth=self.parent.depth + 1
         self.ignore=self.name in deleteList
         #if verbose:
         #    print '# ' + self.pathname + ' has an adjusted depth of ' + str(self.depth)
 
-    def get_lineage(self):                      # DirObj.get_lineage
-        """Crawls back up the directory tree and returns a list of parents"""
-        if self.parent == None:
-            return self.name.split('/')
-        ancestry=self.parent.get_lineage()
-        ancestry.append(self.name)
-        return ancestry
+    @property
+    def pathname(self):                         # DirObj.pathname
+        """Pathnames are not stored, but rebuilt from the parent links"""
+        names=[]
+        d=self
+        while d != None:
+            names.append(d.name)
+            d=d.parent
+        names.reverse()
+        return '/'.join(names)
+
+    def relative_path(self):                    # DirObj.relative_path
+        """Our pathname beneath the argument we were found in, '' for the
+        argument itself
+        """
+        names=[]
+        d=self
+        while d.parent != None:
+            names.append(d.name)
+            d=d.parent
+        names.reverse()
+        return '/'.join(names)
 
     def max_depth(self):                        # DirObj.max_depth
         """Determine the deepest point from this directory"""
@@ -402,33 +2028,7 @@ class DirObj():
         if contents:
             for name, entry in self.files.iteritems():
                 entry.display(contents, recurse);
-        print '# Directory\t' + str(self.deleted) + '\t' + str(self.ignore) + '\t' + str(self.depth) + '\t' + self.hexdigest + ' ' + self.pathname
-
-    def place_dir(self, inputDirName, weightAdjust):    # DirObj.place_dir
-        """Matches a pathname to a directory structure and returns a DirObj"""
-        #print "looking to place " +  inputDirName + " in " + self.name
-        inputDirList=inputDirName.split('/')
-        nameList=self.name.split('/')
-
-        while (len(inputDirList) and len(nameList)):
-            x=inputDirList.pop(0)
-            y=nameList.pop(0)
-            if x != y:
-                print x + ' and ' + y + ' do not match'
-                raise LookupError
-        
-        if len(inputDirList) == 0:
-            return self
-
-        nextDirName=inputDirList[0]
-        if nextDirName in self.subdirs:
-            #print "found " + nextDirName + " in " + self.name
-            return self.subdirs[nextDirName].place_dir('/'.join(inputDirList), weightAdjust)
-
-        #print "did not find " + nextDirName + " in " + self.name
-        nextDir=DirObj(nextDirName, weightAdjust, self)
-        self.subdirs[nextDirName]=nextDir
-        return nextDir.place_dir('/'.join(inputDirList), weightAdjust)
+        print '# Directory\t' + str(self.deleted) + '\t' + str(self.ignore) + '\t' + str(self.depth) + '\t' + binascii.hexlify(self.digest) + ' ' + self.pathname
 
     def dirwalk(self, topdown=False):                      # DirObj.dirwalk
         """A generator which traverses just subdirectories"""
@@ -436,7 +2036,7 @@ class DirObj():
             yield self
 
         for name, d in self.subdirs.iteritems():
-            for dirEntry in d.dirwalk():
+            for dirEntry in d.dirwalk(topdown):
                 yield dirEntry
 
         if not topdown:
@@ -451,168 +2051,356 @@ class DirObj():
             yield fileEntry
         yield self
             
+    def reset(self):                                    # DirObj.reset
+        """Undoes every deletion beneath us, so the tree can be resolved
+        afresh.  tally() should follow.
+        """
+        for d in self.dirwalk():
+            d.deleted=False
+            d.winner=None
+            d.deletedCount=0
+            d.deletedBytes=0
+            for name, f in d.files.iteritems():
+                f.reset()
+
+    def tally(self):                                    # DirObj.tally
+        """Once the tree is built, sets up the subtree counters which
+        delete() keeps current from then on
+        """
+        for d in self.dirwalk():
+            d.liveCount=1 if d.filtered else 0
+            d.totalCount=1
+            d.totalBytes=0
+            for name, f in d.files.iteritems():
+                d.totalCount = d.totalCount + 1
+                d.totalBytes = d.totalBytes + f.bytes
+                if not f.ignore:
+                    d.liveCount = d.liveCount + 1
+            for name, sd in d.subdirs.iteritems():
+                d.totalCount = d.totalCount + sd.totalCount
+                d.totalBytes = d.totalBytes + sd.totalBytes
+                if not sd.ignore and sd.liveCount > 0:
+                    d.liveCount = d.liveCount + 1
+
+    def child_emptied(self):                            # DirObj.child_emptied
+        """A child which kept this directory from being empty no longer does"""
+        d=self
+        while d != None:
+            d.liveCount = d.liveCount - 1
+            if d.liveCount > 0 or d.deleted or d.ignore:
+                break
+            # d just became empty, so its parent lost a reason not to be
+            d=d.parent
+
+    def add_deleted(self, count, bytes):                # DirObj.add_deleted
+        """Adds newly deleted entries to the counters of this directory
+        and all of its ancestors
+        """
+        d=self
+        while d != None:
+            d.deletedCount = d.deletedCount + count
+            d.deletedBytes = d.deletedBytes + bytes
+            d=d.parent
+
     def delete(self):                                   # DirObj.delete
         """Mark this directory and all children as deleted"""
-        self.deleted=True
-        for name, d in self.subdirs.iteritems():
-            d.delete()
-        for name, f in self.files.iteritems():
-            f.delete()
+        if self.deleted:
+            # so is everything beneath us
+            return
+        wasLive = not self.ignore and self.liveCount > 0
+        count = self.totalCount - self.deletedCount
+        bytes = self.totalBytes - self.deletedBytes
+
+        pending=[ self ]
+        while len(pending):
+            d=pending.pop()
+            d.deleted=True
+            d.liveCount=0
+            d.deletedCount=d.totalCount
+            d.deletedBytes=d.totalBytes
+            for name, f in d.files.iteritems():
+                f.deleted=True
+            for name, sd in d.subdirs.iteritems():
+                if not sd.deleted:
+                    pending.append(sd)
+
+        if self.parent != None:
+            self.parent.add_deleted(count, bytes)
+            if wasLive:
+                self.parent.child_emptied()
 
-    def generate_commands(self, selectDirMap, selectFileMap, emptyMap):             # DirObj.generate_commands
-        """Generates delete commands to dedup all contents of this dir"""
+    def generate_commands(self, selectDirMap, selectFileMap, linkMap, emptyMap):    # DirObj.generate_commands
+        """Adds the entries to delete to dedup all contents of this dir to
+        the maps, see EntryList.plan
+        """
         if self.deleted:
             if self.winner != None:
-                if self.winner.pathname in selectDirMap:
-                    selectDirMap[self.winner.pathname].append(self.pathname)
+                if self.winner in selectDirMap:
+                    selectDirMap[self.winner].append(self)
                 else:
-                    selectDirMap[self.winner.pathname] = [ self.pathname ]
+                    selectDirMap[self.winner] = [ self ]
             else:
-                emptyMap[self.pathname]=True
+                emptyMap[self]=True
         else:
             for fileName, fileEntry in self.files.iteritems():
-                fileEntry.generate_commands(selectDirMap, selectFileMap, emptyMap)
+                fileEntry.generate_commands(selectDirMap, selectFileMap, linkMap, emptyMap)
             for dirName, subdir in self.subdirs.iteritems():
-                subdir.generate_commands(selectDirMap, selectFileMap, emptyMap)
+                subdir.generate_commands(selectDirMap, selectFileMap, linkMap, emptyMap)
 
     def is_empty(self):                                 # DirObj.is_empty
         """Checks if the dir is empty, ignoring items marked as deleted or ignored"""
+        return self.liveCount == 0
 
-        for fileName, fileEntry in self.files.iteritems():
-            if not fileEntry.deleted and not fileEntry.ignore:
-                #print '# ' + self.pathname + ' is not empty due to a file ' + fileEntry.name
-                return False
-
-        for dirName, subdir in self.subdirs.iteritems():
-            if not subdir.deleted and not subdir.is_empty() and not subdir.ignore:
-                #print '# ' + self.pathname + ' is not empty due to a dir ' + subdir.name
-                return False
-
-        #print '# ' + self.pathname + ' is empty!'
-        return True
-
-    def prune_empty(self):                              # DirObj.prune_empty
-        """Crawls through all directories and marks the shallowest empty entiries for deletion"""
+    def prune_empty(self, pruned=None):                 # DirObj.prune_empty
+        """Crawls through all directories and marks the shallowest empty entiries for deletion.
+        Directories marked here are appended to 'pruned', if it is given.
+        """
         #print '# checking ' + self.pathname + ' for empties'
         if self.is_empty() and not self.deleted and self.parent == None:
             self.delete()
+            if pruned != None:
+                pruned.append(self)
             #print '# TLD ' + self.pathname + ' is now empty: ' + str(self.is_empty())
         elif self.is_empty() and not self.deleted and self.parent != None and not self.parent.is_empty():
             self.delete()
+            if pruned != None:
+                pruned.append(self)
             #print '# ' + self.pathname + ' is now empty: ' + str(self.is_empty())
         else:
             #print '# ' + self.pathname + ' is not empty: ' + str(self.is_empty())
             for dirname, dirEntry in self.subdirs.iteritems():
-                dirEntry.prune_empty()
+                dirEntry.prune_empty(pruned)
 
-    def finalize(self):                                 # DirObj.finalize
+    def change_token(self):                             # DirObj.change_token
+        """Digests the sorted (name, size, mtime, digest) of each file and
+        (name, digest) of each subdirectory, which is all our digest
+        depends on.  Being a new_hash() digest, it comes out the same in
+        every python, whatever its word size or hash seed.
+        """
+        children=[ ('f', name, str(f.bytes), str(f.mtime), f.digest) for name, f in self.files.iteritems() ]
+        children.extend([ ('d', name, d.digest) for name, d in self.subdirs.iteritems() ])
+        children.sort()
+        h=new_hash()
+        h.update(marshal.dumps((self.filtered, children)))
+        return h.hexdigest()
+
+    def finalize(self, db=None):                        # DirObj.finalize
         """Once no more files or directories are to be added, we can 
         create a meta-hash of all the hashes therein.  This allows us to
-        test for directories which have the same contents.
+        test for directories which have the same contents.  With a db,
+        the digest stored for an unchanged directory is reused.
         """
+        if db != None:
+            token=self.change_token()
+            entry=db.lookup_dir(self.pathname)
+            if entry.get(cache_field('token')) == token and hashName in entry:
+                stats.count('directory digests reused')
+                self.digest=binascii.unhexlify(entry[hashName])
+                return
         digests=[]
         for filename, fileEntry in self.files.iteritems():
-            digests.append(fileEntry.hexdigest)
+            digests.append(fileEntry.digest)
         for dirname, dirEntry in self.subdirs.iteritems():
-            digests.append(dirEntry.hexdigest)
+            digests.append(dirEntry.digest)
         digests.sort()
-        sha1 = hashlib.sha1()
+        h = new_hash()
         for d in digests:
-            sha1.update(d)
-        self.hexdigest=sha1.hexdigest()
+            h.update(d)
+        if self.filtered:
+            # what was left out is unknown, so match nothing
+            h.update('\0filtered\0' + self.pathname)
+        self.digest=h.digest()
+        if db != None:
+            stats.count('directory digests computed')
+            db.store_dir(self.pathname, { cache_field('token'): token, hashName: h.hexdigest() })
 
     def count_deleted_bytes(self):                      # DirObj.count_deleted_bytes
         """returns a count of all the sizes of the deleted objects within"""
-        bytes=0
-        for name, d in self.subdirs.iteritems():
-            bytes = bytes + d.count_deleted_bytes()
-        for name, f in self.files.iteritems():
-            if f.deleted:
-                bytes = bytes + f.count_deleted_bytes()
-        return bytes
+        return self.deletedBytes
 
     def count_deleted(self):                            # DirObj.count_deleted
         """returns a count of all the deleted objects within"""
-        if self.deleted:
-            deleted=1
-        else:
-            deleted=0
-        for name, d in self.subdirs.iteritems():
-            deleted = deleted + d.count_deleted()
-        for name, f in self.files.iteritems():
-            if f.deleted:
-                deleted = deleted + 1
-        return deleted
+        return self.deletedCount
 
-class FileObj():
+class FileObj(object):
     """A file object which stores some metadata"""
-    def __init__(self, name, parent=None, dbTime=None, db=None, weightAdjust=0):
+    __slots__ = ('name', 'parent', 'deleted', 'winner', 'depth', 'ignore',
+                 'digest', 'bytes', 'mtime', 'inode', 'device', 'links')
+
+    def __init__(self, name, parent=None, weightAdjust=0, statResult=None):
         self.name=name;
         self.winner=None
         self.parent = parent
         self.deleted=False
-        self.weightAdjust=weightAdjust
         self.ignore=self.name in deleteList
+        self.digest=None
 
         if self.parent != None:
-            ancestry=self.parent.get_lineage()
-            self.pathname='/'.join(ancestry) + '/' + self.name
-            self.depth=len(ancestry) + self.weightAdjust
+            self.depth=self.parent.depth
         else:
-            self.pathname=self.name
-            self.depth=self.weightAdjust
+            self.depth=weightAdjust
         #if verbose:
         #    print '# ' + self.pathname + ' has an adjusted depth of ' + str(self.depth)
 
-        statResult = os.stat(self.pathname)
-        self.modTime = statResult.st_mtime
-        self.createTime = statResult.st_ctime
+        if statResult == None:
+            statResult = os.stat(self.pathname)
+        self.mtime = mtime_ns(statResult)
         self.bytes = statResult.st_size
+        self.inode = statResult.st_ino
+        self.device = statResult.st_dev
+        self.links = statResult.st_nlink
         if self.bytes == 0:
             self.ignore = True
-            self.hexdigest='da39a3ee5e6b4b0d3255bfef95601890afd80709'
-            return
+            self.digest=new_hash().digest()
 
-        if db != None:
-            #print '# ' + self.pathname + ' is ' + str(dbTime - self.modTime) + ' seconds older than the db.'
-            pass
+    @property
+    def pathname(self):                 # FileObj.pathname
+        """Pathnames are not stored, but rebuilt from the parent links"""
+        if self.parent == None:
+            return self.name
+        return self.parent.pathname + '/' + self.name
 
-        if db != None and self.pathname in db:
-            # we've a cached hash value for this pathname
-            if self.modTime > dbTime:
-                # file is newer than db
-                #print '# ' + self.pathname + ' is newer than the db'
-                pass
-            else:
-                # db is newer than file
-                if verbose:
-					print '# ' + self.pathname + ' already in db'
-                self.hexdigest=db[self.pathname]
-                return
-        elif db != None:
-            #print '# ' + self.pathname + ' not in db'
-            pass
+    @property
+    def modTime(self):                  # FileObj.modTime
+        return self.mtime / 1e9
 
-        # open and read the file
-        sha1 = hashlib.sha1()
+    def set_unique(self, sample=None):  # FileObj.set_unique
+        """No other file has our size (or our fingerprint), so we cannot have
+        a duplicate.  Rather than reading the file, assign a synthetic digest
+        which can never collide with a real one.
+        """
+        if sample == None:
+            self.digest='unique-size:' + str(self.bytes)
+        else:
+            self.digest='unique-sample:' + str(self.bytes) + ':' + sample
+
+    def cached_entry(self, db=None, resumeMap=None):    # FileObj.cached_entry
+        """Returns the cached values for this file, if they can be trusted.
+        Entries are trusted when the size, mtime, inode and device they were
+        computed for still describe this file.  They are looked up by
+        pathname first, then by (device, inode) in case the file was moved.
+        A stale entry for a file which has since been appended to goes in
+        resumeMap, see appended_chunks().
+        """
+        if db == None:
+            return {}
+        entry=db.lookup(self.pathname)
+        if self.matches(entry) or db.trusts_legacy(entry, self.modTime):
+            return entry
+        if len(entry):
+            stats.count('cache entries stale')
+            resume=self.appended_chunks(entry)
+            if resume != None and resumeMap != None:
+                resumeMap[self]=resume
+        entry=db.lookup_identity(self.device, self.inode)
+        if self.matches(entry):
+            stats.count('cache entries found by inode')
+            return entry
+        return {}
+
+    def matches(self, entry):           # FileObj.matches
+        """Checks if a cache entry was computed for this very file"""
+        return entry.get('size') == str(self.bytes) and \
+               entry.get('mtime') == str(self.mtime) and \
+               entry.get('ino') == str(self.inode) and \
+               entry.get('dev') == str(self.device)
+
+    def store_cache_entry(self, db, entry):     # FileObj.store_cache_entry
+        """Stores cached values under our pathname and our identity"""
+        entry['path']=self.pathname
+        entry['size']=str(self.bytes)
+        entry['mtime']=str(self.mtime)
+        entry['ino']=str(self.inode)
+        entry['dev']=str(self.device)
+        db.store(entry)
+
+    def read_sample(self):              # FileObj.read_sample
+        """Returns a fingerprint of the head, tail and a few blocks between"""
         with open(self.pathname, 'rb') as f:
-            while True:
-                data = f.read(BUF_SIZE)
-                if not data:
-                    break
-                sha1.update(data)
-        self.hexdigest=sha1.hexdigest()
+            return sample_range(f, 0, self.bytes)
 
-        if verbose:
-			print '# computed new hash for ' + self.pathname
-
-        if db != None:
-            # add/update the cached hash value for this entry
-            #if self.pathname in db:
-            #    print '# updating db entry for ' + self.pathname
-            #else:
-            #    print '# inserting db entry for ' + self.pathname
-            db[self.pathname]=self.hexdigest
+    def appended_chunks(self, entry):   # FileObj.appended_chunks
+        """If the stale cache entry holds chunk records for a shorter version
+        of this very file, returns (the length they cover, the records).
+        Each record is a chunk's digest and sample, see read_digest().
+        """
+        if self.bytes <= HASH_CHUNK:
+            return None
+        field=cache_field('chunks')
+        if field not in entry or entry.get('ino') != str(self.inode) or entry.get('dev') != str(self.device):
+            return None
+        try:
+            oldBytes=int(entry['size'])
+        except (KeyError, ValueError):
+            return None
+        chunks=entry[field].split(',')
+        if not HASH_CHUNK < oldBytes < self.bytes or len(chunks) != (oldBytes + HASH_CHUNK - 1) / HASH_CHUNK:
+            return None
+        if len([ chunk for chunk in chunks if ':' not in chunk ]):
+            # stored before chunks had samples: nothing to check them by
+            return None
+        return oldBytes, chunks
+
+    def read_digest(self, resume=None): # FileObj.read_digest
+        """Read the file and return (its digest, its chunk records).  An
+        unbuffered file reads straight into a reused buffer, so no string
+        is allocated per block.
+
+        Files up to HASH_CHUNK have no chunk records, their digest is that
+        of their contents.  Larger files have the digest of the list of
+        their chunk digests, and a record of each chunk's digest and
+        sample_range() fingerprint.  Given the (length, chunk records) of
+        an earlier, shorter version of the file, the fingerprint of every
+        chunk but the last is checked and the last chunk is read again: if
+        all still match, hashing carries on from there, and otherwise the
+        file is hashed from scratch.  Fingerprints only sample the chunks,
+        so such a digest is still only a hint until
+        EntryList.confirm_resumed has read the file in full.
+        """
+        buf = hash_buffer()
+        with io.open(self.pathname, 'rb', buffering=0) as f:
+            if self.bytes <= HASH_CHUNK:
+                h = new_hash()
+                hash_range(f, h, buf, self.bytes)
+                return h.hexdigest(), None
+
+            chunks=[]
+            check=None
+            if resume != None:
+                oldBytes, oldChunks = resume
+                chunks=oldChunks[:-1]
+                for i in xrange(len(chunks)):
+                    if sample_range(f, i * HASH_CHUNK, HASH_CHUNK) != chunks[i].split(':')[1]:
+                        # written to in place, not just appended to
+                        stats.count('resumed digests which had to start over')
+                        return self.read_digest()
+                check=(oldBytes - len(chunks) * HASH_CHUNK, oldChunks[-1].split(':')[0])
+                f.seek(len(chunks) * HASH_CHUNK)
+                stats.count('digests resumed after an append')
+
+            offset=len(chunks) * HASH_CHUNK
+            while offset < self.bytes:
+                h = new_hash()
+                length=min(HASH_CHUNK, self.bytes - offset)
+                if check != None:
+                    checkBytes, checkDigest = check
+                    hash_range(f, h, buf, checkBytes)
+                    if h.hexdigest() != checkDigest:
+                        # more than an append happened
+                        stats.count('resumed digests which had to start over')
+                        return self.read_digest()
+                    length = length - checkBytes
+                    check=None
+                hash_range(f, h, buf, length)
+                length=min(HASH_CHUNK, self.bytes - offset)
+                chunks.append(h.hexdigest() + ':' + sample_range(f, offset, length))
+                offset = offset + HASH_CHUNK
+                f.seek(offset)
+
+        h = new_hash()
+        for chunk in chunks:
+            h.update(binascii.unhexlify(chunk.split(':')[0]))
+        return h.hexdigest(), chunks
 
     def max_depth(self):                # FileObj.max_depth
         return self.depth
@@ -623,29 +2411,54 @@ class FileObj():
 
     def delete(self):                   # FileObj.delete
         """Mark for deletion"""
+        if self.deleted:
+            return
         self.deleted=True
+        if self.parent != None:
+            self.parent.add_deleted(1, self.bytes)
+            if not self.ignore:
+                self.parent.child_emptied()
 
-    def generate_commands(self, selectDirMap, selectFileMap, emptyMap):     # FileObj.generate_commands
-        """Generates delete commands to dedup all contents"""
+    def generate_commands(self, selectDirMap, selectFileMap, linkMap, emptyMap):    # FileObj.generate_commands
+        """Adds this file to the maps if it is to be deleted, see EntryList.plan"""
         if self.deleted and not self.ignore:
             if self.winner != None:
-                if self.bytes != self.winner.bytes:
-                    print '# BIRTHDAY CRISIS! matched hashes and mismatched sizes!'
-                    sys.exit(-1)
-                if self.winner.pathname in selectFileMap:
-                    selectFileMap[self.winner.pathname].append(self.pathname)
+                if self.winner in selectFileMap:
+                    selectFileMap[self.winner].append(self)
                 else:
-                    selectFileMap[self.winner.pathname] = [self.pathname]
+                    selectFileMap[self.winner] = [self]
             else:
-                emptyMap[self.pathname] = True
+                emptyMap[self] = True
 
-    def prune_empty(self):                      # FileObj.prune_empty
+    def reset(self):                    # FileObj.reset
+        self.deleted=False
+        self.winner=None
+
+    def tally(self):                    # FileObj.tally
+        """Files keep no counters, see DirObj.tally"""
+        pass
+
+    def manifest_record(self, relativePath):    # FileObj.manifest_record
+        """Returns our record for EntryList.write_manifest"""
+        return ('f', relativePath, self.bytes, self.mtime, self.inode, self.device, self.links, self.digest)
+
+    def is_hardlinked(self):            # FileObj.is_hardlinked
+        # some filesystems report no inode numbers at all
+        return self.links > 1 and self.inode != 0
+
+    def same_file(self, other):         # FileObj.same_file
+        """Checks if other is another link to our inode, or us under
+        another name (through a symlink)
+        """
+        return self.inode != 0 and self.inode == other.inode and self.device == other.device
+
+    def prune_empty(self, pruned=None):         # FileObj.prune_empty
         """Crawls through all directories and deletes the children of the deleted"""
         return False            # can't prune a file
 
     def display(self, contents=False, recurse=False):  # FileObj.display
         """Generate a human readable report."""
-        print '# File\t\t' + str(self.deleted) + '\t' + str(self.ignore) + '\t' + str(self.depth) + '\t' + self.hexdigest + ' ' + self.pathname + ' '
+        print '# File\t\t' + str(self.deleted) + '\t' + str(self.ignore) + '\t' + str(self.depth) + '\t' + binascii.hexlify(self.digest) + ' ' + self.pathname + ' '
 
     def count_deleted_bytes(self):              # FileObj.count_deleted_bytes
         """Returns a count of all the sizes of the deleted objects within"""
@@ -661,38 +2474,774 @@ class FileObj():
         else:
             return 0
 
-def clean_database(databasePathname):
-    """function to remove dead nodes from the hash db"""
+class Inotify:
+    """Just enough of Linux's inotify, through ctypes"""
+    def __init__(self):
+        self.libc=ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd=self.libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+
+    def fileno(self):                           # Inotify.fileno
+        return self.fd
+
+    def add_watch(self, pathname, mask):        # Inotify.add_watch
+        """Returns the watch descriptor, or None if pathname is gone"""
+        wd=self.libc.inotify_add_watch(self.fd, pathname, mask)
+        if wd < 0:
+            return None
+        return wd
+
+    def rm_watch(self, wd):                     # Inotify.rm_watch
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self):                      # Inotify.read_events
+        """Returns a list of (wd, mask, cookie, name) waiting to be read"""
+        data=os.read(self.fd, 65536)
+        events=[]
+        offset=0
+        while offset < len(data):
+            wd, mask, cookie, length = struct.unpack_from('=iIII', data, offset)
+            offset = offset + 16
+            name=data[offset:offset+length].rstrip('\0')
+            offset = offset + length
+            events.append((wd, mask, cookie, name))
+        return events
+
+class Watcher:
+    """Keeps the digests of a scanned tree current by following inotify
+    events, and answers queries about it over a unix socket:
+        dups <path>     paths with the same contents as path
+        plan            the commands dedup.py would print right now
+    """
+    def __init__(self, allFiles, socketPathname):
+        self.allFiles=allFiles
+        # the db was closed once the scan was hashed, and new digests are
+        # not worth a write each
+        allFiles.db=None
+        self.inotify=Inotify()
+        self.watches={}         # DirObj to watch descriptor
+        self.watched={}         # watch descriptor to DirObj
+        self.digestMap={}       # digest to the set of entries which have it
+        self.planText=None      # kept until something changes
+
+        for name, e in allFiles.contents.iteritems():
+            if isinstance(e, DirObj):
+                for dirEntry in e.dirwalk():
+                    dirEntry.finalize()
+                    self.watch(dirEntry)
+            self.index(e)
+
+        if os.path.exists(socketPathname):
+            os.unlink(socketPathname)
+        self.socketPathname=socketPathname
+        self.server=socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(socketPathname)
+        self.server.listen(16)
+        print '# watching ' + str(len(self.watches)) + ' directories, queries on ' + socketPathname
+        sys.stdout.flush()
+
+    def watch(self, dirEntry):                  # Watcher.watch
+        wd=self.inotify.add_watch(dirEntry.pathname, WATCH_MASK)
+        if wd != None:
+            self.watches[dirEntry]=wd
+            self.watched[wd]=dirEntry
+
+    def index(self, entry):                     # Watcher.index
+        """Adds entry and everything beneath it to digestMap"""
+        for e in entry.walk():
+            if e.digest in self.digestMap:
+                self.digestMap[e.digest].add(e)
+            else:
+                self.digestMap[e.digest] = set([ e ])
+
+    def unindex(self, e):                       # Watcher.unindex
+        """Removes just e from digestMap"""
+        entries=self.digestMap.get(e.digest)
+        if entries != None:
+            entries.discard(e)
+            if len(entries) == 0:
+                del self.digestMap[e.digest]
+
+    def detach(self, dirEntry, name):           # Watcher.detach
+        """Takes the child called name out of dirEntry, returning it"""
+        if name in dirEntry.files:
+            entry=dirEntry.files.pop(name)
+        elif name in dirEntry.subdirs:
+            entry=dirEntry.subdirs.pop(name)
+        else:
+            return None
+        for e in entry.walk():
+            self.unindex(e)
+        return entry
+
+    def attach(self, dirEntry, name, entry):    # Watcher.attach
+        """Makes entry the child called name of dirEntry"""
+        self.detach(dirEntry, name)
+        entry.name=intern(name)
+        entry.parent=dirEntry
+        entry.ignore=entry.name in deleteList
+        if isinstance(entry, FileObj):
+            entry.ignore=entry.ignore or entry.bytes == 0
+            if dirEntry.files is NO_CHILDREN:
+                dirEntry.files={}
+            dirEntry.files[entry.name]=entry
+            entry.depth=dirEntry.depth
+        else:
+            if dirEntry.subdirs is NO_CHILDREN:
+                dirEntry.subdirs={}
+            dirEntry.subdirs[entry.name]=entry
+            for d in entry.dirwalk(topdown=True):
+                d.depth=d.parent.depth + 1
+                for fileName, f in d.files.iteritems():
+                    f.depth=d.depth
+        self.index(entry)
+
+    def forget(self, entry):                    # Watcher.forget
+        """Stops watching a detached entry"""
+        if isinstance(entry, DirObj):
+            for d in entry.dirwalk():
+                wd=self.watches.pop(d, None)
+                if wd != None:
+                    del self.watched[wd]
+                    self.inotify.rm_watch(wd)
+
+    def serve(self):                            # Watcher.serve
+        """Handles inotify events and queries until interrupted"""
+        try:
+            self.loop()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.server.close()
+            os.unlink(self.socketPathname)
+
+    def loop(self):                             # Watcher.loop
+        while True:
+            readable, writable, broken = select.select([ self.inotify, self.server ], [], [])
+            if self.inotify in readable:
+                events=self.inotify.read_events()
+                # let a burst of changes finish before acting on it
+                while len(select.select([ self.inotify ], [], [], WATCH_SETTLE)[0]):
+                    events.extend(self.inotify.read_events())
+                self.update(events)
+            if self.server in readable:
+                conn, address = self.server.accept()
+                try:
+                    self.answer(conn)
+                except socket.error:
+                    pass
+                finally:
+                    conn.close()
+
+    def update(self, events):                   # Watcher.update
+        """Applies a batch of inotify events to the tree.  Moves within the
+        tree keep their entries (and digests), anything created or written
+        to is hashed again, and then the digests of every directory above
+        a change are worked out again.
+        """
+        touched=set()
+        changed=[]
+        changedSet=set()
+        moved={}                # cookie to the entry moved away
+        for wd, mask, cookie, name in events:
+            if mask & IN_Q_OVERFLOW:
+                print '# inotify queue overflowed, changes were missed'
+            if wd not in self.watched:
+                continue
+            dirEntry=self.watched[wd]
+            if mask & IN_IGNORED:
+                # the directory itself is gone
+                del self.watched[wd]
+                self.watches.pop(dirEntry, None)
+                continue
+            touched.add(dirEntry)
+            if mask & IN_MOVED_FROM:
+                entry=self.detach(dirEntry, name)
+                if entry != None:
+                    moved[cookie]=entry
+            elif mask & IN_DELETE:
+                entry=self.detach(dirEntry, name)
+                if entry != None:
+                    self.forget(entry)
+            elif mask & IN_MOVED_TO and cookie in moved and not excluded((dirEntry.relative_path() + '/' + name).lstrip('/')):
+                self.attach(dirEntry, name, moved.pop(cookie))
+            elif (dirEntry, name) not in changedSet:
+                changedSet.add((dirEntry, name))
+                changed.append((dirEntry, name))
+        for cookie, entry in moved.iteritems():
+            # moved out of the tree
+            self.forget(entry)
+
+        # scan and hash what was created or written to
+        newEntries=[]
+        newFiles=[]
+        for dirEntry, name in changed:
+            if dirEntry not in self.watches:
+                continue
+            entry=self.detach(dirEntry, name)
+            if entry != None:
+                self.forget(entry)
+            relativePath=(dirEntry.relative_path() + '/' + name).lstrip('/')
+            if excluded(relativePath):
+                dirEntry.filtered=True
+                continue
+            pathname=dirEntry.pathname + '/' + name
+            try:
+                statResult=os.stat(pathname)
+            except OSError:
+                continue
+            if stat.S_ISDIR(statResult.st_mode):
+                if os.path.islink(pathname):
+                    continue
+                entry=DirObj(intern(name), 0, dirEntry)
+                if dirEntry.subdirs is NO_CHILDREN:
+                    dirEntry.subdirs={}
+                dirEntry.subdirs[entry.name]=entry
+                self.allFiles.scan_dir(entry, 0)
+                for d in entry.dirwalk(topdown=True):
+                    self.watch(d)
+                newFiles.extend([ e for e in entry.walk() if isinstance(e, FileObj) ])
+            elif stat.S_ISREG(statResult.st_mode):
+                if filtered_file(relativePath, statResult):
+                    dirEntry.filtered=True
+                    continue
+                entry=FileObj(intern(name), parent=dirEntry, statResult=statResult)
+                if dirEntry.files is NO_CHILDREN:
+                    dirEntry.files={}
+                dirEntry.files[entry.name]=entry
+                newFiles.append(entry)
+            else:
+                continue
+            newEntries.append(entry)
+
+        readList=[ f for f in newFiles if f.bytes > 0 ]
+        for fileEntry, value in parallel_map(self.read_digest, readList):
+            if value == None:
+                # changed again under us, the events for that are on
+                # their way.  until then it matches nothing.
+                fileEntry.digest='unreadable:' + fileEntry.pathname
+            else:
+                fileEntry.digest=binascii.unhexlify(value)
+        for entry in newEntries:
+            if isinstance(entry, DirObj):
+                for d in entry.dirwalk():
+                    d.finalize()
+            self.index(entry)
+
+        # then every directory above a change, deepest first
+        ancestors=set()
+        for d in touched:
+            while d != None and d not in ancestors:
+                ancestors.add(d)
+                d=d.parent
+        for d in sorted(ancestors, key=lambda d: d.depth, reverse=True):
+            self.unindex(d)
+            d.finalize()
+            self.index_one(d)
+
+        if len(events):
+            self.planText=None
+            if verbose:
+                sys.stderr.write('# applied ' + str(len(events)) + ' events, ' + str(len(newFiles)) + ' files hashed\n')
+
+    def read_digest(self, fileEntry):           # Watcher.read_digest
+        """Returns (fileEntry, its hex digest), or (fileEntry, None) if it
+        could not be read
+        """
+        try:
+            return fileEntry, fileEntry.read_digest()[0]
+        except (IOError, OSError):
+            return fileEntry, None
+
+    def index_one(self, e):                     # Watcher.index_one
+        if e.digest in self.digestMap:
+            self.digestMap[e.digest].add(e)
+        else:
+            self.digestMap[e.digest] = set([ e ])
+
+    def find(self, pathname):                   # Watcher.find
+        """Returns the entry at pathname, or None"""
+        pathname=pathname.rstrip('/')
+        for name in self.allFiles.contents.iterkeys():
+            if pathname == name or pathname.startswith(name + '/'):
+                try:
+                    return self.allFiles.lookup(name, pathname[len(name)+1:])
+                except KeyError:
+                    return None
+        return None
+
+    def plan(self):                             # Watcher.plan
+        """Resolves the tree afresh and returns what dedup.py would print.
+        The plan is only answered as a script, and nothing is streamed.
+        """
+        global outputFormat
+        if self.planText != None:
+            return self.planText
+        allFiles=self.allFiles
+        for name, e in allFiles.contents.iteritems():
+            e.reset()
+            e.tally()
+        allFiles.fileList=[ e for e in allFiles.walk() if isinstance(e, FileObj) ]
+        allFiles.find_links()
+
+        realStdout=sys.stdout
+        realFormat=outputFormat
+        sys.stdout=io.BytesIO()
+        outputFormat='shell'
+        try:
+            resolve_all(allFiles)
+            allFiles.generate_commands()
+            print '# total bytes marked for deletion (not including directory files): ' + str(allFiles.count_deleted_bytes())
+            self.planText=sys.stdout.getvalue()
+        finally:
+            sys.stdout=realStdout
+            outputFormat=realFormat
+        return self.planText
+
+    def answer(self, conn):                     # Watcher.answer
+        """Reads one request from conn and writes the answer back"""
+        conn.settimeout(5)
+        request=''
+        while '\n' not in request:
+            data=conn.recv(4096)
+            if not data:
+                break
+            request = request + data
+        request=request.split('\n')[0]
+        if request == 'plan':
+            conn.sendall(self.plan())
+        elif request.startswith('dups '):
+            entry=self.find(request[5:])
+            if entry == None:
+                conn.sendall('# not found: ' + request[5:] + '\n')
+                return
+            others=[ e.pathname for e in self.digestMap.get(entry.digest, ()) if e is not entry ]
+            for pathname in sorted(others):
+                conn.sendall(pathname + '\n')
+        else:
+            conn.sendall('# unknown request, try: plan, dups <path>\n')
+
+class Applier:
+    """Carries out a resolved plan itself, with a pool of 'jobs' threads,
+    rather than through a generated script.  Nothing is touched unless the
+    loser and its winner still have the size and mtime they were scanned
+    with.  Redundant directories are taken apart file by file, so anything
+    which appeared in them since the scan survives (along with the
+    directories holding it).
+    """
+    def __init__(self, allFiles, link=False, dryRun=False, journalPathname=None):
+        self.allFiles=allFiles
+        self.link=link                  # replace losers with hardlinks to winners
+        self.dryRun=dryRun
+        self.journal=None
+        if journalPathname != None and not dryRun:
+            self.journal=open(journalPathname, 'a')
+        self.lock=threading.Lock()
+        self.winnerChecks={}            # winner to whether it is unchanged
+        self.counters=collections.defaultdict(int)
+
+    def note(self, op, pathname, winner, state, reason=None):  # Applier.note
+        """Counts an action, and journals it.  Each action is journaled
+        before it is attempted and again once it is over, so a journal cut
+        short by a crash shows what was under way.
+        """
+        with self.lock:
+            if state != 'begin':
+                self.counters[op + ' ' + state] = self.counters[op + ' ' + state] + 1
+            if verbose and state != 'begin':
+                print '# ' + op + ' ' + pathname + ': ' + (reason or state)
+            if self.journal != None:
+                record={ 'op': op, 'path': json_path(pathname), 'state': state, 'time': time.time() }
+                if winner != None:
+                    record['winner']=json_path(winner.pathname)
+                if reason != None:
+                    record['reason']=reason
+                self.journal.write(json.dumps(record, sort_keys=True) + '\n')
+                self.journal.flush()
+
+    def unchanged(self, fileEntry):             # Applier.unchanged
+        """Checks that the file is still a regular file (not a symlink to
+        one) with the size and mtime it was scanned with
+        """
+        try:
+            statResult=os.lstat(fileEntry.pathname)
+        except OSError:
+            return False
+        return stat.S_ISREG(statResult.st_mode) and statResult.st_size == fileEntry.bytes and \
+               mtime_ns(statResult) == fileEntry.mtime
+
+    def winner_unchanged(self, winner):         # Applier.winner_unchanged
+        """Checks a winner, or every file a winning directory keeps, once"""
+        if winner not in self.winnerChecks:
+            if isinstance(winner, FileObj):
+                ok=self.unchanged(winner)
+            else:
+                ok=True
+                for e in winner.walk():
+                    if isinstance(e, FileObj) and not e.deleted and not self.unchanged(e):
+                        ok=False
+                        break
+            self.winnerChecks[winner]=ok
+        return self.winnerChecks[winner]
+
+    def distinct(self, loser, winner):          # Applier.distinct
+        """Returns why loser must not be replaced by winner, or None.  Both
+        must still be a real directory or regular file, and not the same
+        one reached twice (through a symlink, or overlapping arguments).
+        Only two names of a hardlinked file may share an inode.
+        """
+        try:
+            loserStat=os.lstat(loser.pathname)
+            winnerStat=os.lstat(winner.pathname)
+        except OSError, e:
+            return e.strerror
+        for e, statResult in ((loser, loserStat), (winner, winnerStat)):
+            if isinstance(e, DirObj) and not stat.S_ISDIR(statResult.st_mode):
+                return e.pathname + ' is no longer a directory'
+            if isinstance(e, FileObj) and not stat.S_ISREG(statResult.st_mode):
+                return e.pathname + ' is no longer a regular file'
+        if (loserStat.st_dev, loserStat.st_ino) != (winnerStat.st_dev, winnerStat.st_ino):
+            return None
+        if isinstance(loser, FileObj) and loserStat.st_nlink > 1:
+            # two names of one file, unless both are the same name
+            try:
+                loserDir=os.lstat(os.path.dirname(loser.pathname) or '.')
+                winnerDir=os.lstat(os.path.dirname(winner.pathname) or '.')
+            except OSError, e:
+                return e.strerror
+            if os.path.basename(loser.pathname) != os.path.basename(winner.pathname) or \
+               (loserDir.st_dev, loserDir.st_ino) != (winnerDir.st_dev, winnerDir.st_ino):
+                return None
+        return 'same file as its winner'
+
+    def freed(self, pathname):                  # Applier.freed
+        """Bytes unlinking pathname would free"""
+        statResult=os.lstat(pathname)
+        if stat.S_ISLNK(statResult.st_mode) or statResult.st_nlink > 1:
+            return 0
+        return statResult.st_size
+
+    def remove_file(self, fileEntry, winner):   # Applier.remove_file
+        if winner != None and not self.winner_unchanged(winner):
+            self.note('unlink', fileEntry.pathname, winner, 'skipped', 'winner changed since the scan')
+            return 0
+        if not self.unchanged(fileEntry):
+            self.note('unlink', fileEntry.pathname, winner, 'skipped', 'changed since the scan')
+            return 0
+        if isinstance(winner, FileObj):
+            reason=self.distinct(fileEntry, winner)
+            if reason != None:
+                self.note('unlink', fileEntry.pathname, winner, 'skipped', reason)
+                return 0
+        self.note('unlink', fileEntry.pathname, winner, 'begin')
+        try:
+            bytes=self.freed(fileEntry.pathname)
+            if not self.dryRun:
+                os.unlink(fileEntry.pathname)
+        except OSError, e:
+            self.note('unlink', fileEntry.pathname, winner, 'failed', e.strerror)
+            return 0
+        self.note('unlink', fileEntry.pathname, winner, 'done')
+        return bytes
+
+    def remove_dir(self, dirEntry, winner):     # Applier.remove_dir
+        """Removes the files we know of beneath dirEntry, then each
+        directory if that left it empty.  A directory is often empty only
+        because what was in it lost to copies elsewhere, so every file is
+        checked against its own winner, and against the winner of the
+        nearest directory holding it which has one.  Files failing either
+        check stay, and so do the directories holding them.
+        """
+        dirWinners={}
+        for d in dirEntry.dirwalk(topdown=True):
+            if d.winner != None:
+                dirWinners[d]=d.winner
+            elif d is dirEntry:
+                dirWinners[d]=winner
+            else:
+                dirWinners[d]=dirWinners[d.parent]
+        bytes=0
+        for d in dirEntry.dirwalk():
+            for name, fileEntry in d.files.iteritems():
+                if dirWinners[d] != None and not self.winner_unchanged(dirWinners[d]):
+                    self.note('unlink', fileEntry.pathname, dirWinners[d], 'skipped', 'winner changed since the scan')
+                    continue
+                bytes = bytes + self.remove_file(fileEntry, fileEntry.winner)
+            if self.dryRun:
+                self.note('rmdir', d.pathname, winner, 'done')
+                continue
+            self.note('rmdir', d.pathname, winner, 'begin')
+            try:
+                os.rmdir(d.pathname)
+            except OSError, e:
+                self.note('rmdir', d.pathname, winner, 'failed', e.strerror)
+                continue
+            self.note('rmdir', d.pathname, winner, 'done')
+        return bytes
+
+    def link_file(self, fileEntry, winner):     # Applier.link_file
+        """Replaces fileEntry with a hardlink to winner.  The link is made
+        beside it and renamed over it, so the name is never missing.
+        """
+        if not self.unchanged(fileEntry) or not self.unchanged(winner):
+            self.note('link', fileEntry.pathname, winner, 'skipped', 'changed since the scan')
+            return 0
+        self.note('link', fileEntry.pathname, winner, 'begin')
+        try:
+            if os.path.samefile(fileEntry.pathname, winner.pathname):
+                # already linked, or one name reached twice.  (renaming a
+                # link over another link to the same file does nothing.)
+                self.note('link', fileEntry.pathname, winner, 'skipped', 'already the same file')
+                return 0
+            bytes=self.freed(fileEntry.pathname)
+            if not self.dryRun:
+                temporary=fileEntry.pathname + '.dedup-link'
+                os.link(winner.pathname, temporary)
+                try:
+                    os.rename(temporary, fileEntry.pathname)
+                except OSError:
+                    os.unlink(temporary)
+                    raise
+        except OSError, e:
+            self.note('link', fileEntry.pathname, winner, 'failed', e.strerror)
+            return 0
+        self.note('link', fileEntry.pathname, winner, 'done')
+        return bytes
+
+    def link_dir(self, dirEntry, winner):       # Applier.link_dir
+        """Links each file beneath dirEntry to a file with its contents
+        beneath winner.  Names may differ, as directory digests leave them
+        out, and ignored files are left as they are.
+        """
+        digestMap={}
+        for e in winner.walk():
+            if isinstance(e, FileObj) and not e.deleted and not e.ignore:
+                digestMap.setdefault(e.digest, e)
+        bytes=0
+        for e in dirEntry.walk():
+            if isinstance(e, FileObj) and not e.ignore and e.digest in digestMap:
+                bytes = bytes + self.link_file(e, digestMap[e.digest])
+        return bytes
+
+    def link_empty(self, dirEntry):             # Applier.link_empty
+        """Links what a directory left empty holds: each redundant
+        directory within to its winner, and each other file to its own
+        """
+        bytes=0
+        pending=[ dirEntry ]
+        while len(pending):
+            d=pending.pop()
+            if d.winner != None:
+                bytes = bytes + self.link_dir(d, d.winner)
+                continue
+            for name, fileEntry in d.files.iteritems():
+                if fileEntry.winner != None and not fileEntry.ignore:
+                    bytes = bytes + self.link_file(fileEntry, fileEntry.winner)
+            pending.extend(d.subdirs.itervalues())
+        return bytes
+
+    def apply_one(self, task):                  # Applier.apply_one
+        """Carries out one (loser, winner) task, returning the bytes freed"""
+        loser, winner = task
+        if winner != None and not self.winner_unchanged(winner):
+            self.note('remove', loser.pathname, winner, 'skipped', 'winner changed since the scan')
+            return loser, 0
+        if isinstance(winner, DirObj):
+            reason=self.distinct(loser, winner)
+            if reason != None:
+                self.note('remove', loser.pathname, winner, 'skipped', reason)
+                return loser, 0
+        if self.link:
+            if winner == None:
+                return loser, self.link_empty(loser)
+            if isinstance(loser, FileObj):
+                return loser, self.link_file(loser, winner)
+            return loser, self.link_dir(loser, winner)
+        if isinstance(loser, FileObj):
+            return loser, self.remove_file(loser, winner)
+        return loser, self.remove_dir(loser, winner)
+
+    def run(self):                              # Applier.run
+        """Applies the plan of allFiles, returning the bytes freed"""
+        selectDirMap, selectFileMap, linkMap, emptyMap = self.allFiles.plan()
+        tasks=[]
+        for winnerMap in (selectDirMap, selectFileMap):
+            for winner in sorted(winnerMap.keys(), key=lambda e: e.pathname):
+                for loser in winnerMap[winner]:
+                    tasks.append((loser, winner))
+        # when linking, what an empty directory holds is linked instead
+        for emptyDir in sorted(emptyMap.keys(), key=lambda e: e.pathname):
+            tasks.append((emptyDir, None))
+
+        # no task lies beneath another, as nothing beneath a redundant or
+        # empty directory is listed on its own, so any order will do
+        stats.begin('applying', sum(loser.totalBytes if isinstance(loser, DirObj) else loser.bytes for loser, winner in tasks))
+        start=time.time()
+        bytes=0
+        for loser, freed in parallel_map(self.apply_one, tasks):
+            bytes = bytes + freed
+            stats.advance(1, loser.totalBytes if isinstance(loser, DirObj) else loser.bytes)
+        stats.end()
+        if self.journal != None:
+            self.journal.close()
+
+        elapsed=max(time.time() - start, 0.001)
+        done=sum(n for name, n in self.counters.iteritems() if name.endswith(' done'))
+        sys.stderr.write('# ' + ('dry run: ' if self.dryRun else 'applied: ') + str(done) + ' actions in ' +
+                         format_seconds(elapsed) + ', ' + str(int(done / elapsed)) + ' per second, ' +
+                         format_bytes(bytes) + ' freed (' + format_bytes(bytes / elapsed) + '/s)\n')
+        for name in sorted(self.counters.keys()):
+            sys.stderr.write('# ' + name + ': ' + str(self.counters[name]) + '\n')
+        return bytes
+
+def clean_database(databasePathname, prefixes=[]):
+    """Removes the entries of the hash db which no longer describe anything
+    on disk, only looking at those under prefixes if any are given.  Keys
+    are streamed in sorted batches.  While a pool of threads stats the
+    pathnames of one batch, the dead keys of the batch before are deleted
+    (gdbm spills them to a temporary file until its walk is over).
+    """
     print '# loading database ' + databasePathname
     try:
-        db = gdbm.open(databasePathname, 'w')
+        db = open_cache(databasePathname, 'w')
     except:
         print "# " + databasePathname + " could not be loaded"
         sys.exit(-1)
 
-    # even though gdbm supports memory efficient iteration over
-    # all keys, I want to order my traversal across similar
-    # paths to leverage caching of directory files:
-    allKeys=db.keys()
-    print '# finished loaded keys from ' + databasePathname
-    allKeys.sort()
-    print '# finished sorting keys from ' + databasePathname
-    print '# deleting dead nodes'
+    pool=ThreadPool(max(jobs, GC_JOBS))
+    checked=0
     count=0
-    for currKey in allKeys:
-        try:
-            os.stat(currKey)
-            sys.stdout.write('.')
-        except OSError:
-            del db[currKey]
-            sys.stdout.write('*')
-            count=count+1
-        sys.stdout.flush()
-    print "\n# reorganizing " + databasePathname
-    db.reorganize()
-    db.sync()
+    start=time.time()
+    lastShown=start
+    pending=None
+    try:
+        # a None batch at the end flushes the last pending one
+        for batch in itertools.chain(db.gc_batches(prefixes, GC_BATCH), [ None ]):
+            result=None
+            if batch != None:
+                result=pool.map_async(dead_key, batch)
+            if pending != None:
+                pendingBatch, pendingResult = pending
+                for item, dead in itertools.izip(pendingBatch, pendingResult.get()):
+                    if dead:
+                        db.delete(item[0])
+                        count=count+1
+                checked=checked + len(pendingBatch)
+                now=time.time()
+                if now - lastShown >= PROGRESS_INTERVAL:
+                    lastShown=now
+                    sys.stderr.write('# cleaning: ' + str(checked) + ' keys checked, ' + str(count) + ' removed, ' +
+                                     str(int(checked / max(now - start, 0.001))) + ' keys/s\n')
+            pending=(batch, result)
+    finally:
+        pool.close()
+        pool.join()
+
+    # reorganizing rewrites the whole db, which only pays once much of it is gone
+    total=db.key_count() + count
+    reorganize=count > 0 and count >= total * GC_REORGANIZE
+    if reorganize:
+        print '# reorganizing ' + databasePathname
+    db.close(reorganize=reorganize)
+    print '# done cleaning ' + databasePathname + ', checked ' + str(checked) + ' keys, removed ' + str(count) + ' dead nodes!'
+
+def import_database(sourcePathname, databasePathname):
+    """Copies the entries of a gdbm hash cache into another cache, such as
+    a sqlite one.  Entries from before file metadata was cached are checked
+    against the gdbm file's mtime, as they would have been, and stored with
+    the metadata of the file on disk.
+    """
+    print '# importing ' + sourcePathname + ' into ' + databasePathname
+    try:
+        source = GdbmCache(sourcePathname, 'r')
+    except:
+        print "# " + sourcePathname + " could not be loaded"
+        sys.exit(-1)
+    db = open_cache(databasePathname)
+
+    count=0
+    skipped=0
+    for key in source.keys():
+        if key.startswith('\0'):
+            # identity entries duplicate the pathname entries, and
+            # directory digests are cheap to work out again
+            continue
+        entry=source.lookup(key)
+        if 'mtime' not in entry:
+            try:
+                statResult=os.stat(key)
+            except OSError:
+                statResult=None
+            if statResult == None or statResult.st_mtime > source.modTime:
+                # gone, or changed since it was hashed
+                skipped=skipped+1
+                continue
+            entry['size']=str(statResult.st_size)
+            entry['mtime']=str(mtime_ns(statResult))
+            entry['ino']=str(statResult.st_ino)
+            entry['dev']=str(statResult.st_dev)
+        entry['path']=key
+        db.store(entry)
+        count=count+1
+
+    source.close()
     db.close()
-    print '# done cleaning ' + databasePathname + ', removed ' + str(count) + ' dead nodes!'
+    print '# imported ' + str(count) + ' entries, skipped ' + str(skipped) + ' stale ones'
+
+def resolve_all(allFiles, spillDir=None):
+    """Prunes and resolves allFiles, pass after pass, until a pass finds
+    nothing more to delete.  Returns the number of passes.
+    """
+    passCount=0
+    h=None
+    deleted=1                   # fake value to get the loop started
+    while deleted > 0:          # while things are still being removed, keep working
+        passStart=time.time()
+
+        stats.begin('pruning')
+        pruned=[]
+        deletedDirectories = allFiles.prune_empty(pruned)
+        for emptyDir in pruned:
+            emit_group(allFiles, None, [ emptyDir ], 'empty directory')
+        stats.end()
+
+        if h == None:
+            stats.begin('building the hash map')
+            h = HashMap(allFiles, spillDir)
+            stats.end()
+        else:
+            # digests do not change from pass to pass, just which
+            # entries are still alive
+            h.note_deleted(pruned)
+        stats.begin('resolving')
+        deletedHashMatches = h.resolve()
+        stats.end()
+
+        deleted = deletedDirectories + deletedHashMatches
+        passCount = passCount + 1
+        if deleted > 0:
+            print '# ' + str(deleted) + ' entries deleted on pass ' + str(passCount)
+        sys.stderr.write('# pass ' + str(passCount) + ': ' + str(deletedDirectories) + ' pruned, ' +
+                         str(deletedHashMatches) + ' resolved in ' + format_seconds(time.time() - passStart) + '\n')
+    return passCount
+
+def query_watcher(socketPathname, request):
+    """Sends request to a --watch process and returns its answer"""
+    sock=socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socketPathname)
+        sock.sendall(request + '\n')
+        sock.shutdown(socket.SHUT_WR)
+        answer=[]
+        while True:
+            data=sock.recv(65536)
+            if not data:
+                break
+            answer.append(data)
+    finally:
+        sock.close()
+    return ''.join(answer)
 
 if __name__ == '__main__':
     startTime=time.time()
@@ -701,6 +3250,17 @@ if __name__ == '__main__':
     # defaults
     databasePathname=None
     cleanDatabase=False
+    importPathname=None
+    spillDir=None
+    profilePathname=None
+    manifestPathname=None
+    fromManifest=False
+    watchSocket=None
+    querySocket=None
+    applyPlan=False
+    applyLinks=False
+    dryRun=False
+    journalPathname=None
     staggerPaths=False
     again=True
     while again:
@@ -721,47 +3281,251 @@ if __name__ == '__main__':
                 print '# argument needed for -db switch'
                 sys.exit(-1)
             again=True
+        if nextArg == '-idb' or nextArg == '--import-database':
+            sys.argv.pop(0)
+            try:
+                importPathname=sys.argv.pop(0)
+            except IndexError:
+                print '# argument needed for -idb switch'
+                sys.exit(-1)
+            again=True
         if nextArg == '-cdb' or nextArg == '--clean-database':
             sys.argv.pop(0)
             cleanDatabase=True
             again=True
+        if nextArg == '-j' or nextArg == '--jobs':
+            sys.argv.pop(0)
+            try:
+                jobs=int(sys.argv.pop(0))
+            except (IndexError, ValueError):
+                print '# numeric argument needed for -j switch'
+                sys.exit(-1)
+            if jobs < 1:
+                print '# -j needs at least 1 job'
+                sys.exit(-1)
+            again=True
+        if nextArg == '--hash':
+            sys.argv.pop(0)
+            try:
+                hashName=sys.argv.pop(0)
+            except IndexError:
+                print '# argument needed for --hash switch'
+                sys.exit(-1)
+            if hashName not in hash_algorithms():
+                print '# unknown hash ' + hashName + ', choose from: ' + ' '.join(hash_algorithms())
+                sys.exit(-1)
+            again=True
+        if nextArg == '--hdd-jobs':
+            sys.argv.pop(0)
+            try:
+                hddJobs=int(sys.argv.pop(0))
+            except (IndexError, ValueError):
+                print '# numeric argument needed for --hdd-jobs switch'
+                sys.exit(-1)
+            if hddJobs < 1:
+                print '# --hdd-jobs needs at least 1 job'
+                sys.exit(-1)
+            again=True
+        if nextArg == '--exclude' or nextArg == '--include':
+            sys.argv.pop(0)
+            try:
+                pattern=compile_pattern(sys.argv.pop(0))
+            except IndexError:
+                print '# pattern argument needed for ' + nextArg + ' switch'
+                sys.exit(-1)
+            except re.error, e:
+                print '# bad pattern for ' + nextArg + ' switch: ' + str(e)
+                sys.exit(-1)
+            if nextArg == '--exclude':
+                excludeList.append(pattern)
+            else:
+                includeList.append(pattern)
+            again=True
+        if nextArg == '--min-size':
+            sys.argv.pop(0)
+            try:
+                minSize=int(sys.argv.pop(0))
+            except (IndexError, ValueError):
+                print '# numeric argument needed for --min-size switch'
+                sys.exit(-1)
+            again=True
+        if nextArg == '--max-size':
+            sys.argv.pop(0)
+            try:
+                maxSize=int(sys.argv.pop(0))
+            except (IndexError, ValueError):
+                print '# numeric argument needed for --max-size switch'
+                sys.exit(-1)
+            again=True
+        if nextArg == '-b' or nextArg == '--buffer-size':
+            sys.argv.pop(0)
+            try:
+                BUF_SIZE=int(sys.argv.pop(0))
+            except (IndexError, ValueError):
+                print '# numeric argument needed for -b switch'
+                sys.exit(-1)
+            if BUF_SIZE < 1:
+                print '# -b needs a buffer of at least 1 byte'
+                sys.exit(-1)
+            again=True
+        if nextArg == '--external-sort':
+            sys.argv.pop(0)
+            try:
+                spillDir=sys.argv.pop(0)
+            except IndexError:
+                print '# directory argument needed for --external-sort switch'
+                sys.exit(-1)
+            again=True
+        if nextArg == '-o' or nextArg == '--output-format':
+            sys.argv.pop(0)
+            try:
+                outputFormat=sys.argv.pop(0)
+            except IndexError:
+                outputFormat=None
+            if outputFormat not in OUTPUT_FORMATS:
+                print '# -o switch needs one of: ' + ' '.join(OUTPUT_FORMATS)
+                sys.exit(-1)
+            again=True
+        if nextArg == '--emit-manifest':
+            sys.argv.pop(0)
+            try:
+                manifestPathname=sys.argv.pop(0)
+            except IndexError:
+                print '# file argument needed for --emit-manifest switch'
+                sys.exit(-1)
+            hashAll=True
+            again=True
+        if nextArg == '--from-manifest':
+            sys.argv.pop(0)
+            fromManifest=True
+            again=True
+        if nextArg == '--watch':
+            sys.argv.pop(0)
+            try:
+                watchSocket=sys.argv.pop(0)
+            except IndexError:
+                print '# socket argument needed for --watch switch'
+                sys.exit(-1)
+            hashAll=True
+            again=True
+        if nextArg == '--query':
+            sys.argv.pop(0)
+            try:
+                querySocket=sys.argv.pop(0)
+            except IndexError:
+                print '# socket argument needed for --query switch'
+                sys.exit(-1)
+            again=True
+        if nextArg == '--apply':
+            sys.argv.pop(0)
+            applyPlan=True
+            again=True
+        if nextArg == '--link':
+            sys.argv.pop(0)
+            applyPlan=True
+            applyLinks=True
+            again=True
+        if nextArg == '-n' or nextArg == '--dry-run':
+            sys.argv.pop(0)
+            applyPlan=True
+            dryRun=True
+            again=True
+        if nextArg == '--journal':
+            sys.argv.pop(0)
+            try:
+                journalPathname=sys.argv.pop(0)
+            except IndexError:
+                print '# file argument needed for --journal switch'
+                sys.exit(-1)
+            applyPlan=True
+            again=True
+        if nextArg == '--verify':
+            sys.argv.pop(0)
+            verifyContents=True
+            again=True
+        if nextArg == '-p' or nextArg == '--progress':
+            sys.argv.pop(0)
+            stats.showProgress=True
+            again=True
+        if nextArg == '--profile':
+            sys.argv.pop(0)
+            try:
+                profilePathname=sys.argv.pop(0)
+            except IndexError:
+                print '# file argument needed for --profile switch'
+                sys.exit(-1)
+            again=True
         if nextArg == '-s' or nextArg == '--stagger-paths':
             sys.argv.pop(0)
             staggerPaths=True
             again=True
 
+    if querySocket != None:
+        # the rest of the arguments make up the request
+        sys.stdout.write(query_watcher(querySocket, ' '.join(sys.argv)))
+        sys.exit(0)
+
+    if outputFormat != 'shell':
+        # keep the plan on stdout and move our commentary out of its way
+        planStream=sys.stdout
+        sys.stdout=sys.stderr
+
     if databasePathname != None:
         print '# set to use database: ' + databasePathname
         if cleanDatabase:
-            clean_database(databasePathname)
+            # paths given limit cleaning to the entries beneath them
+            clean_database(databasePathname, [ path.rstrip('/') for path in sys.argv ])
+            sys.exit(0)
+        if importPathname != None:
+            import_database(importPathname, databasePathname)
             sys.exit(0)
     elif cleanDatabase:
         print '# database file must be specified for --clean-database command (use -db)'
         sys.exit(-1)
+    elif importPathname != None:
+        print '# database file must be specified for --import-database command (use -db)'
+        sys.exit(-1)
 
-    allFiles = EntryList(sys.argv, databasePathname, staggerPaths)
-    print '# files loaded'
-    passCount=0
-    deleted=1                   # fake value to get the loop started
-    while deleted > 0:          # while things are still being removed, keep working
-
-        h = HashMap(allFiles)
-        deletedDirectories = allFiles.prune_empty()
-
-        h = HashMap(allFiles)
-        deletedHashMatches = h.resolve()
+    if profilePathname != None:
+        # only the main thread is profiled, hashing threads show up as
+        # time spent waiting on the pool
+        profiler=cProfile.Profile()
+        profiler.enable()
 
-        deleted = deletedDirectories + deletedHashMatches
-        passCount = passCount + 1
-        if deleted > 0:
-            print '# ' + str(deleted) + ' entries deleted on pass ' + str(passCount)
+    if fromManifest and (verifyContents or manifestPathname != None or applyPlan):
+        print '# --from-manifest cannot be combined with --verify, --emit-manifest or --apply'
+        sys.exit(-1)
 
-    allFiles.generate_commands()
+    allFiles = EntryList(sys.argv, databasePathname, staggerPaths, fromManifest)
+    print '# files loaded'
+    if manifestPathname != None:
+        allFiles.write_manifest(manifestPathname)
+        print '# manifest written to ' + manifestPathname
+        sys.exit(0)
+    if watchSocket != None:
+        Watcher(allFiles, watchSocket).serve()
+        sys.exit(0)
+    resolve_all(allFiles, spillDir)
+
+    if applyPlan:
+        Applier(allFiles, applyLinks, dryRun, journalPathname).run()
+    elif outputFormat == 'shell':
+        stats.begin('generating commands')
+        allFiles.generate_commands()
+        stats.end()
+
+    if profilePathname != None:
+        profiler.disable()
+        profiler.dump_stats(profilePathname)
+        sys.stderr.write('# profile written to ' + profilePathname + ' (see python -m pstats)\n')
+    stats.report()
 
     #for e in allFiles.walk():
     #    e.display(False,False)
     endTime=time.time()
     print '# total bytes marked for deletion (not including directory files): ' + str(allFiles.count_deleted_bytes()) + '\n'
+    print '# bytes never read: ' + str(allFiles.uniqueSizeBytes) + ' with a unique size, ' + str(allFiles.sampledBytes) + ' ruled out by sampling'
+    print '# peak memory: ' + str(peak_memory()) + ' bytes, ' + str(peak_memory() / max(1, len(allFiles.fileList) + allFiles.dirCount)) + ' bytes per entry'
     print '# total running time: ' + str(endTime - startTime) + ' seconds.'
 
 # vim: set expandtab sw=4 ts=4: